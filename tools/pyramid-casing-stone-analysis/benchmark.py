@@ -0,0 +1,468 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw
+from psd_tools import PSDImage
+from psd_tools.api.layers import Group, PixelLayer
+
+import psd_to_svg
+import svg_reader
+from block_index import BlockIndex
+import webpagescript
+from svg_writer import SVGPath, write_svg
+
+PSD_MAX_SIZE = 30000
+
+
+def synthetic_blocks(block_count, seed=0):
+    """Return point arrays shaped like the approxPolyDP output of a course of casing stones."""
+    rng = np.random.default_rng(seed)
+    blocks = []
+    x = 0
+    for _ in range(block_count):
+        width = int(rng.integers(40, 400))
+        height = int(rng.integers(80, 160))
+        # A slightly skewed quadrilateral with a few extra points
+        outline = [(x + width, 0), (x, 1), (x - 2, height), (x + width + 1, height + 1)]
+        for _ in range(int(rng.integers(0, 4))):
+            extra_point = (x + int(rng.integers(0, width)), int(rng.integers(0, height)))
+            outline.insert(int(rng.integers(1, len(outline))), extra_point)
+        blocks.append(np.array(outline, dtype=np.int32) + rng.integers(-3, 4, size=(len(outline), 2)))
+        x += width + int(rng.integers(2, 10))
+    return blocks
+
+
+def best_of(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def benchmark_corners(block_counts, repeat):
+    """Compare estimate_corner_points and calculate_angle per block with the batched corner kernel."""
+    for block_count in block_counts:
+        blocks = synthetic_blocks(block_count)
+        tuple_blocks = [[tuple(point) for point in block.tolist()] for block in blocks]
+
+        def per_block():
+            results = []
+            for points in tuple_blocks:
+                top_left, top_right, bottom_left, bottom_right = psd_to_svg.estimate_corner_points(points)
+                results.append(((top_left, top_right, bottom_left, bottom_right), (
+                    round(psd_to_svg.calculate_angle(top_left, top_right)),
+                    round(psd_to_svg.calculate_angle(bottom_left, bottom_right)),
+                    round(psd_to_svg.calculate_angle(top_left, bottom_left)),
+                    round(psd_to_svg.calculate_angle(top_right, bottom_right)),
+                )))
+            return results
+
+        def batched():
+            corners, angles = psd_to_svg.estimate_corners_and_angles(blocks)
+            return [(tuple(map(tuple, block_corners)), tuple(block_angles))
+                    for block_corners, block_angles in zip(corners.tolist(), angles.tolist())]
+
+        per_block_seconds, expected = best_of(per_block, repeat)
+        batched_seconds, actual = best_of(batched, repeat)
+        if actual != expected:
+            raise AssertionError(f"Batched corners differ from estimate_corner_points for {block_count} blocks")
+
+        print(f"{block_count:>7} blocks: per block {per_block_seconds * 1000:9.2f}ms, "
+              f"batched {batched_seconds * 1000:8.2f}ms, {per_block_seconds / batched_seconds:6.1f}x faster")
+
+
+def offloaded_by_scan(min_x, max_x, previous_course_bottom_row):
+    """The original offload test, scanning all bottom edges of the previous course."""
+    is_offloaded = True
+    for bottom_left_x, bottom_right_x in previous_course_bottom_row.values():
+        if (min_x <= bottom_left_x <= max_x) or (min_x <= bottom_right_x <= max_x):
+            is_offloaded = False
+            break
+    if not any(bottom_left_x <= max_x and bottom_right_x >= min_x
+               for bottom_left_x, bottom_right_x in previous_course_bottom_row.values()):
+        is_offloaded = False
+    return is_offloaded
+
+
+def synthetic_bottom_rows(block_count, seed=0):
+    """Return the bottom edges of two neighbouring courses, including a few degenerate and reversed ones."""
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(2):
+        widths = rng.integers(0, 300, size=block_count)
+        lefts = np.cumsum(widths + rng.integers(-20, 20, size=block_count))
+        rights = lefts + widths
+        # Corner estimation on skewed blocks can give a bottom right corner left of the bottom left one
+        reversed_edges = rng.random(block_count) < 0.02
+        lefts[reversed_edges], rights[reversed_edges] = rights[reversed_edges], lefts[reversed_edges]
+        rows.append(list(zip(lefts.tolist(), rights.tolist())))
+    return rows
+
+
+def benchmark_offload(block_counts, repeat):
+    """Compare the offload test scanning the previous course with the BottomRowIndex, which must agree exactly."""
+    for block_count in block_counts:
+        previous_row, current_row = synthetic_bottom_rows(block_count)
+        previous_course_bottom_row = dict(enumerate(previous_row, start=1))
+        min_x, max_x = np.array(current_row).T
+
+        def scan():
+            return [offloaded_by_scan(left, right, previous_course_bottom_row) for left, right in current_row]
+
+        def indexed():
+            return psd_to_svg.BottomRowIndex(previous_row).is_offloaded(min_x, max_x).tolist()
+
+        scan_seconds, expected = best_of(scan, repeat)
+        indexed_seconds, actual = best_of(indexed, repeat)
+        if actual != expected:
+            raise AssertionError(f"BottomRowIndex disagrees with the scan for {block_count} blocks")
+
+        print(f"{block_count:>7} blocks: scan {scan_seconds * 1000:10.2f}ms, "
+              f"indexed {indexed_seconds * 1000:8.2f}ms, {scan_seconds / indexed_seconds:8.1f}x faster, "
+              f"{sum(expected)} offloaded")
+
+
+def synthetic_layer(courses, blocks, seed=0):
+    """Return the white blob image of a flattened face of courses of synthetic blocks, as a single layer."""
+    course_blocks = [synthetic_blocks(blocks, seed + course) for course in range(courses)]
+    width = max(int(points[:, 0].max()) for outlines in course_blocks for points in outlines) + 10
+    image = np.zeros((courses * 170 + 10, width), dtype=np.uint8)
+    for course, outlines in enumerate(course_blocks):
+        cv2.fillPoly(image, [points + (5, 5 + course * 170) for points in outlines], 255)
+    return image
+
+
+def benchmark_tiles(cases, tile_size, workers, repeat):
+    """Compare finding the contours of a whole flattened face at once with the ContourTiler, which must agree."""
+    with ThreadPoolExecutor(workers) as executor:
+        for courses, blocks in cases:
+            image = synthetic_layer(courses, blocks)
+
+            def whole():
+                return cv2.findContours(image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]
+
+            def tiled():
+                return psd_to_svg.ContourTiler(tile_size, executor).find_contours(image)
+
+            whole_seconds, expected = best_of(whole, repeat)
+            tiled_seconds, actual = best_of(tiled, repeat)
+            if len(actual) != len(expected) or not all(map(np.array_equal, actual, expected)):
+                raise AssertionError(f"Tiled contours differ from the whole image for {courses}x{blocks} blocks")
+
+            print(f"{courses:>4}x{blocks:<5} ({image.shape[1]}x{image.shape[0]} pixels, {len(expected)} blocks): "
+                  f"whole {whole_seconds * 1000:8.2f}ms, tiled {tiled_seconds * 1000:8.2f}ms, "
+                  f"{whole_seconds / tiled_seconds:5.1f}x faster")
+
+
+def benchmark_components(cases, repeat):
+    """Compare extracting the blocks of a layer with cv2.findContours and with the ComponentExtractor, which must
+    agree."""
+    for courses, blocks in cases:
+        image = synthetic_layer(courses, blocks)
+
+        def contours():
+            return psd_to_svg.extract_block_points(image)
+
+        def components():
+            return psd_to_svg.extract_block_points(image, components=psd_to_svg.ComponentExtractor())
+
+        contours_seconds, expected = best_of(contours, repeat)
+        components_seconds, actual = best_of(components, repeat)
+        if len(actual) != len(expected) or not all(map(np.array_equal, actual, expected)):
+            raise AssertionError(f"The connected components differ from the contours for {courses}x{blocks} blocks")
+
+        print(f"{courses:>4}x{blocks:<5} ({image.shape[1]}x{image.shape[0]} pixels, {len(expected)} blocks): "
+              f"contours {contours_seconds * 1000:8.2f}ms, components {components_seconds * 1000:8.2f}ms, "
+              f"{contours_seconds / components_seconds:5.1f}x faster")
+
+
+def synthetic_svg(svg_path, courses, blocks, seed=0):
+    """Write an SVG file like the converter does, with courses of synthetic blocks."""
+    paths = []
+    for course in range(1, courses + 1):
+        for block_number, points in enumerate(synthetic_blocks(blocks, seed + course), start=1):
+            group_id = f"N_{course}_{block_number}"
+            path = SVGPath(group_id, f"path_{group_id}", block_number, points + (5, 5 + course * 170))
+            path.attributes = {'Course': str(course)}
+            paths.append(path)
+    write_svg(svg_path, blocks * 220, courses * 170 + 180, paths)
+
+
+def read_points_by_string_parsing(svg_path):
+    """Read the block outlines like add_custom_attributes_with_elementtree does."""
+    blocks = []
+    for path_element in ET.parse(svg_path).getroot().iter('{http://www.w3.org/2000/svg}path'):
+        parsed_d_values = path_element.attrib['d'].replace('M', '').replace('Z', '').split('L')
+        blocks.append([tuple(map(int, value.split(','))) for value in parsed_d_values])
+    return blocks
+
+
+def benchmark_ingest(cases, repeat):
+    """Compare reading the block outlines of an SVG file by string parsing with svg_reader, which must agree."""
+    with tempfile.TemporaryDirectory() as folder:
+        for courses, blocks in cases:
+            svg_path = os.path.join(folder, f'{courses}x{blocks}.svg')
+            synthetic_svg(svg_path, courses, blocks)
+
+            def string_parsing():
+                return read_points_by_string_parsing(svg_path)
+
+            def numpy_parsing():
+                return svg_reader.read_face(svg_path).paths
+
+            string_seconds, expected = best_of(string_parsing, repeat)
+            numpy_seconds, paths = best_of(numpy_parsing, repeat)
+            if [[tuple(point) for point in path.points.tolist()] for path in paths] != expected:
+                raise AssertionError(f"svg_reader disagrees with the string parsing for {courses}x{blocks} blocks")
+
+            print(f"{courses:>4}x{blocks:<5} ({os.path.getsize(svg_path) / 1024 / 1024:6.1f} MiB): "
+                  f"string parsing {string_seconds * 1000:8.2f}ms, svg_reader {numpy_seconds * 1000:8.2f}ms, "
+                  f"{string_seconds / numpy_seconds:5.1f}x faster")
+
+
+def synthetic_paths(courses, blocks):
+    """Return the ``SVGPath`` objects of a face with courses of synthetic blocks, a few pixels apart."""
+    paths = []
+    for course in range(1, courses + 1):
+        for block_number, points in enumerate(synthetic_blocks(blocks, course), start=1):
+            group_id = f"N_{course}_{block_number}"
+            paths.append(SVGPath(group_id, f"path_{group_id}", block_number, points + (5, 5 + course * 165)))
+    return paths
+
+
+def benchmark_index(cases, queries, seed=0):
+    """Time the queries of the block index on random points and rectangles, and check the range and nearest
+    queries against a scan of all blocks."""
+    rng = np.random.default_rng(seed)
+    for courses, blocks in cases:
+        paths = synthetic_paths(courses, blocks)
+        start = time.perf_counter()
+        index = BlockIndex.from_paths(paths)
+        build_seconds = time.perf_counter() - start
+        max_x, max_y = index.boxes[:, 2:].max(axis=0).tolist()
+
+        seconds = {'range': 0.0, 'nearest': 0.0, 'adjacent': 0.0, 'scan': 0.0}
+        for _ in range(queries):
+            min_x, min_y = int(rng.integers(0, max_x)), int(rng.integers(0, max_y))
+            rectangle = (min_x, min_y, min_x + int(rng.integers(0, 2000)), min_y + int(rng.integers(0, 500)))
+            x, y = float(rng.uniform(0, max_x)), float(rng.uniform(0, max_y))
+
+            start = time.perf_counter()
+            found = index.range(*rectangle)
+            seconds['range'] += time.perf_counter() - start
+            start = time.perf_counter()
+            nearest = index.nearest(x, y)
+            seconds['nearest'] += time.perf_counter() - start
+            start = time.perf_counter()
+            index.adjacent(nearest[0])
+            seconds['adjacent'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            boxes = index.boxes
+            scanned = np.flatnonzero((boxes[:, 0] <= rectangle[2]) & (boxes[:, 2] >= rectangle[0]) &
+                                     (boxes[:, 1] <= rectangle[3]) & (boxes[:, 3] >= rectangle[1]))
+            seconds['scan'] += time.perf_counter() - start
+            if found != [index.ids[position] for position in scanned]:
+                raise AssertionError(f"The range query disagrees with the scan of all blocks at {rectangle}")
+            # A nearer block would have its bounding box within that distance
+            distance = index.distance(nearest[0], x, y)
+            nearer = index.range(x - distance, y - distance, x + distance, y + distance)
+            if any(index.distance(block_id, x, y) < distance for block_id in nearer):
+                raise AssertionError(f"The nearest block to {x}, {y} is not {nearest[0]}")
+
+        print(f"{courses:>4}x{blocks:<5}: build {build_seconds * 1000:7.1f}ms, "
+              + ', '.join(f"{name} {total / queries * 1000:6.3f}ms" for name, total in seconds.items()))
+
+
+def synthetic_psd(psd_path, courses, blocks, block_width=100, course_height=60, seed=0):
+    """Write a PSD file with a group per course holding a layer of white, slightly skewed blocks."""
+    rng = np.random.default_rng(seed)
+    width = blocks * (block_width + 8) + 40
+    height = courses * course_height + 20
+    if max(width, height) > PSD_MAX_SIZE:
+        raise ValueError(f"A face of {width}x{height} pixels exceeds the PSD maximum of {PSD_MAX_SIZE} pixels")
+    psd = PSDImage.new('RGBA', (width, height))
+    for course in range(1, courses + 1):
+        group = Group.new(psd, name=f"Course {course}")
+        image = Image.new('RGBA', (width, course_height), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        x = 20
+        for _ in range(blocks):
+            block = int(rng.integers(block_width // 2, block_width * 3 // 2))
+            skew = int(rng.integers(-block_width // 16, block_width // 16 + 1))
+            outline = [(x + max(skew, 0), 3), (x + block - max(-skew, 0), 2), (x + block, course_height - 3),
+                       (x, course_height - 4)]
+            draw.polygon(outline, fill=(255, 255, 255, 255))
+            x += block + int(rng.integers(3, 9))
+        PixelLayer.frompil(image, group, name=f"Course {course} blocks", top=height - 10 - course * course_height,
+                           left=0)
+    psd.save(psd_path)
+
+
+def run_pipeline(psd_path, folder, single_pass):
+    """Convert the PSD file to input/face.svg in the folder and generate the viewer page from it.
+
+    Returns the timings, the peak memory and the output sizes.
+    """
+    os.chdir(folder)
+    converter = psd_to_svg.PSDConverter(single_pass=single_pass)
+    result = converter.convert(psd_path, os.path.join('input', 'face.svg'))
+
+    start = time.perf_counter()
+    with open('index.html', 'w', encoding='utf-8') as file:
+        file.write(webpagescript.generate_html(['face.svg']))
+    html_seconds = time.perf_counter() - start
+
+    return {
+        'seconds': result.seconds + html_seconds,
+        'stages': dict(result.stages, generate_html={'seconds': html_seconds, 'calls': 1}),
+        'peak_memory_mb': psd_to_svg.peak_memory_mb(),
+        'svg_bytes': os.path.getsize(result.svg_path),
+        'html_bytes': os.path.getsize('index.html'),
+    }
+
+
+def in_new_process(function, *args):
+    """Call the function in a spawned process, whose peak memory is not inflated by earlier work of this one."""
+    # The peak memory survives fork and exec, so the fixtures are made in separate processes as well
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+
+def benchmark_pipeline(cases, block_width, course_height, single_pass, repeat, fixtures=None, output=None,
+                       baseline=None):
+    """Time every stage of the conversion and the page generation for faces of the given (courses, blocks) sizes.
+
+    The synthetic PSD files are kept in the ``fixtures`` folder, if given, and reused by later runs. Every run
+    happens in a new process, so the peak memory belongs to that run alone.
+    """
+    results = {
+        'single_pass': single_pass,
+        'block_width': block_width,
+        'course_height': course_height,
+        'cases': {},
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        fixtures = os.path.abspath(fixtures or folder)
+        os.makedirs(fixtures, exist_ok=True)
+        os.mkdir(os.path.join(folder, 'input'))
+        for courses, blocks in cases:
+            name = f"{courses}x{blocks}"
+            psd_path = os.path.join(fixtures, f"face_{name}_{block_width}_{course_height}.psd")
+            if not os.path.exists(psd_path):
+                in_new_process(synthetic_psd, psd_path, courses, blocks, block_width, course_height)
+
+            runs = [in_new_process(run_pipeline, psd_path, folder, single_pass) for _ in range(repeat)]
+            best = min(runs, key=lambda run: run['seconds'])
+            best['peak_memory_mb'] = max(run['peak_memory_mb'] for run in runs)
+            results['cases'][name] = best
+            print_case(name, best, (baseline or {}).get('cases', {}).get(name))
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    return results
+
+
+def print_case(name, case, baseline_case=None):
+    def change(new, old):
+        return f" ({new / old:5.2f}x)" if old else ''
+
+    baseline_stages = (baseline_case or {}).get('stages', {})
+    print(f"{name:>12}: {case['seconds'] * 1000:9.1f}ms"
+          f"{change(case['seconds'], (baseline_case or {}).get('seconds'))}, "
+          f"peak memory {case['peak_memory_mb']:.0f} MiB"
+          f"{change(case['peak_memory_mb'], (baseline_case or {}).get('peak_memory_mb'))}")
+    for stage, timing in case['stages'].items():
+        old = baseline_stages.get(stage, {}).get('seconds')
+        print(f"{stage:>26} {timing['seconds'] * 1000:9.1f}ms{change(timing['seconds'], old)}")
+
+
+def parse_case(text):
+    courses, _, blocks = text.partition('x')
+    return int(courses), int(blocks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the casing stone converter.")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    corners = subparsers.add_parser('corners', help="corner and angle estimation per course")
+    corners.add_argument('--blocks', type=int, nargs='+', default=[100, 1000, 10000],
+                         help="numbers of blocks per course (default: 100 1000 10000)")
+    corners.add_argument('--repeat', type=int, default=3, help="runs per measurement, the best one counts")
+
+    offload = subparsers.add_parser('offload', help="offload test against the previous course")
+    offload.add_argument('--blocks', type=int, nargs='+', default=[100, 1000, 5000],
+                         help="numbers of blocks per course (default: 100 1000 5000)")
+    offload.add_argument('--repeat', type=int, default=3, help="runs per measurement, the best one counts")
+
+    tiles = subparsers.add_parser('tiles', help="contours of a whole flattened face, tiled and at once")
+    tiles.add_argument('--faces', type=parse_case, nargs='+', default=[(10, 100), (40, 100)],
+                       help="face sizes as COURSESxBLOCKS, blocks per course (default: 10x100 40x100)")
+    tiles.add_argument('--tile-size', type=int, default=2048, help="tile size in pixels (default: %(default)s)")
+    tiles.add_argument('--workers', type=int, default=os.cpu_count(),
+                       help="number of threads (default: number of CPUs)")
+    tiles.add_argument('--repeat', type=int, default=3, help="runs per measurement, the best one counts")
+
+    components = subparsers.add_parser('components', help="block extraction by contours and by connected components")
+    components.add_argument('--faces', type=parse_case, nargs='+', default=[(5, 200), (10, 300)],
+                            help="layer sizes as COURSESxBLOCKS, blocks per course (default: 5x200 10x300)")
+    components.add_argument('--repeat', type=int, default=3, help="runs per measurement, the best one counts")
+
+    ingest = subparsers.add_parser('ingest', help="reading the blocks of a converted SVG file")
+    ingest.add_argument('--faces', type=parse_case, nargs='+', default=[(10, 100), (50, 1000)],
+                        help="face sizes as COURSESxBLOCKS, blocks per course (default: 10x100 50x1000)")
+    ingest.add_argument('--repeat', type=int, default=3, help="runs per measurement, the best one counts")
+
+    index = subparsers.add_parser('index', help="range, nearest and adjacency queries of the block index")
+    index.add_argument('--faces', type=parse_case, nargs='+', default=[(10, 100), (50, 1000)],
+                       help="face sizes as COURSESxBLOCKS, blocks per course (default: 10x100 50x1000)")
+    index.add_argument('--queries', type=int, default=1000, help="queries of every kind (default: %(default)s)")
+
+    pipeline = subparsers.add_parser('pipeline', help="all stages from the PSD file to the viewer page")
+    pipeline.add_argument('--faces', type=parse_case, nargs='+', default=[(10, 50), (20, 100), (30, 200)],
+                          help="face sizes as COURSESxBLOCKS, blocks per course (default: 10x50 20x100 30x200)")
+    pipeline.add_argument('--block-width', type=int, default=100, help="average block width in pixels")
+    pipeline.add_argument('--course-height', type=int, default=60, help="course height in pixels")
+    pipeline.add_argument('--legacy', action='store_true',
+                          help="benchmark the flow re-parsing the SVG file per course instead of the single pass")
+    pipeline.add_argument('--repeat', type=int, default=1, help="runs per face, the fastest one counts")
+    pipeline.add_argument('--fixtures', help="keep the synthetic PSD files in this folder and reuse them")
+    pipeline.add_argument('--output', help="write the results to this JSON file")
+    pipeline.add_argument('--compare', help="show the changes relative to the results in this JSON file")
+
+    args = parser.parse_args()
+    if args.benchmark == 'corners':
+        benchmark_corners(args.blocks, args.repeat)
+    elif args.benchmark == 'offload':
+        benchmark_offload(args.blocks, args.repeat)
+    elif args.benchmark == 'tiles':
+        benchmark_tiles(args.faces, args.tile_size, args.workers, args.repeat)
+    elif args.benchmark == 'components':
+        benchmark_components(args.faces, args.repeat)
+    elif args.benchmark == 'ingest':
+        benchmark_ingest(args.faces, args.repeat)
+    elif args.benchmark == 'index':
+        benchmark_index(args.faces, args.queries)
+    elif args.benchmark == 'pipeline':
+        baseline = None
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as file:
+                baseline = json.load(file)
+        benchmark_pipeline(args.faces, args.block_width, args.course_height, not args.legacy, args.repeat,
+                           args.fixtures, args.output, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import os
+
+import cv2
+import numpy as np
+
+# Blocks whose outlines are at most this many pixels apart are adjacent, across the joints drawn between them
+ADJACENCY_TOLERANCE = 8
+
+
+def index_path(svg_path):
+    """Return the path of the block index of the SVG file, like ``North.index.npz`` next to ``North.svg``."""
+    return f'{os.path.splitext(svg_path)[0]}.index.npz'
+
+
+def point_outline_distances(points, outline):
+    """Return the distance of every point to the closed outline through the outline points."""
+    starts = outline.astype(np.float64)
+    edges = np.roll(starts, -1, axis=0) - starts
+    lengths = np.maximum((edges ** 2).sum(axis=1), 1e-12)
+    relative = points[:, None, :] - starts[None, :, :]
+    t = np.clip((relative * edges).sum(axis=2) / lengths, 0, 1)
+    return np.sqrt(((relative - t[..., None] * edges) ** 2).sum(axis=2)).min(axis=1)
+
+
+def outline_distance(outline, other):
+    """Return the distance between two outlines, as the shortest distance of a point of one to the other."""
+    return min(point_outline_distances(outline, other).min(), point_outline_distances(other, outline).min())
+
+
+class BlockIndex:
+    """A grid over the bounding boxes of the blocks of a face, for range, nearest and adjacency queries.
+
+    Every cell of the grid lists the blocks whose bounding box overlaps it, so that a query only looks at the
+    blocks in the cells around it. The cells are about as large as a block. The blocks are known by their group
+    ids, like ``N_3_12``, and the boxes are ``(min_x, min_y, max_x, max_y)`` in pixels.
+    """
+
+    def __init__(self, ids, boxes, offsets, points, grid, cell_starts, cell_items):
+        self.ids = list(ids)
+        self.boxes = boxes
+        self.offsets = offsets
+        self.points = points
+        self.grid = grid  # cell size, x and y of the first cell, columns and rows
+        self.cell_starts = cell_starts
+        self.cell_items = cell_items
+        self.positions = {block_id: position for position, block_id in enumerate(self.ids)}
+
+    @classmethod
+    def from_paths(cls, paths, cell_size=None):
+        """Index the ``SVGPath`` objects of a face, by default in cells of the median size of the blocks."""
+        paths = list(paths)
+        outlines = [np.asarray(path.points, dtype=np.int32).reshape(-1, 2) for path in paths]
+        offsets = np.cumsum([0] + [len(outline) for outline in outlines])
+        if not outlines:
+            return cls([], np.empty((0, 4), np.int32), offsets, np.empty((0, 2), np.int32), np.array([1, 0, 0, 0, 0]),
+                       np.zeros(1, np.int64), np.empty(0, np.int64))
+        points = np.concatenate(outlines)
+        boxes = np.hstack([np.minimum.reduceat(points, offsets[:-1]), np.maximum.reduceat(points, offsets[:-1])])
+
+        if cell_size is None:
+            cell_size = int(np.median(np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]))) + 1
+        origin_x, origin_y = boxes[:, :2].min(axis=0)
+        columns = (boxes[:, 2].max() - origin_x) // cell_size + 1
+        rows = (boxes[:, 3].max() - origin_y) // cell_size + 1
+        grid = np.array([cell_size, origin_x, origin_y, columns, rows], dtype=np.int64)
+
+        # The cells of every block, as runs of cells in row-major order
+        first_column = (boxes[:, 0] - origin_x) // cell_size
+        first_row = (boxes[:, 1] - origin_y) // cell_size
+        widths = (boxes[:, 2] - origin_x) // cell_size - first_column + 1
+        heights = (boxes[:, 3] - origin_y) // cell_size - first_row + 1
+        counts = widths * heights
+        blocks = np.repeat(np.arange(len(boxes)), counts)
+        steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cells = (first_row[blocks] + steps // widths[blocks]) * columns + first_column[blocks] + steps % widths[blocks]
+
+        order = np.argsort(cells, kind='stable')
+        cell_starts = np.searchsorted(cells[order], np.arange(columns * rows + 1))
+        return cls([path.group_id for path in paths], boxes, offsets, points, grid, cell_starts, blocks[order])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def box(self, block_id):
+        return tuple(self.boxes[self.positions[block_id]].tolist())
+
+    def outline(self, block_id):
+        """Return the outline of the block as an array of points."""
+        return self._outline(self.positions[block_id])
+
+    def _outline(self, position):
+        return self.points[self.offsets[position]:self.offsets[position + 1]]
+
+    def _cells(self, min_x, min_y, max_x, max_y):
+        """Return the columns and rows of the cells overlapping the rectangle, clipped to the grid."""
+        cell_size, origin_x, origin_y, columns, rows = self.grid.tolist()
+        return (max(0, int((min_x - origin_x) // cell_size)), min(columns - 1, int((max_x - origin_x) // cell_size)),
+                max(0, int((min_y - origin_y) // cell_size)), min(rows - 1, int((max_y - origin_y) // cell_size)))
+
+    def _candidates(self, min_x, min_y, max_x, max_y):
+        """Return the positions of the blocks in the cells overlapping the rectangle, in block order."""
+        first_column, last_column, first_row, last_row = self._cells(min_x, min_y, max_x, max_y)
+        if first_column > last_column or first_row > last_row:
+            return np.empty(0, np.int64)
+        columns = int(self.grid[3])
+        starts = self.cell_starts
+        # The cells of a row are next to each other, so the blocks of a row of cells are one slice
+        return np.unique(np.concatenate([
+            self.cell_items[starts[row * columns + first_column]:starts[row * columns + last_column + 1]]
+            for row in range(first_row, last_row + 1)
+        ]))
+
+    def range(self, min_x, min_y, max_x, max_y):
+        """Return the ids of the blocks whose bounding box overlaps the rectangle, in block order."""
+        candidates = self._candidates(min_x, min_y, max_x, max_y)
+        boxes = self.boxes[candidates]
+        inside = ((boxes[:, 0] <= max_x) & (boxes[:, 2] >= min_x) & (boxes[:, 1] <= max_y) & (boxes[:, 3] >= min_y))
+        return [self.ids[position] for position in candidates[inside].tolist()]
+
+    def distance(self, block_id, x, y):
+        """Return the distance of the point to the outline of the block, 0 inside the block."""
+        return self._distance(self.positions[block_id], x, y)
+
+    def _distance(self, position, x, y):
+        outline = self._outline(position).reshape(-1, 1, 2)
+        return max(0.0, -cv2.pointPolygonTest(outline, (float(x), float(y)), True))
+
+    def nearest(self, x, y, count=1):
+        """Return the ids of the ``count`` blocks nearest to the point, by the distance to their outline, nearest
+        first.
+
+        The cells are searched in growing squares around the point, until no block outside the square can be
+        nearer than the ones found.
+        """
+        if not self.ids:
+            return []
+        cell_size, origin_x, origin_y, columns, rows = self.grid.tolist()
+        column = min(max(int((x - origin_x) // cell_size), 0), columns - 1)
+        row = min(max(int((y - origin_y) // cell_size), 0), rows - 1)
+        distances = {}
+        radius = 0
+        while True:
+            left, right = origin_x + (column - radius) * cell_size, origin_x + (column + radius + 1) * cell_size
+            top, bottom = origin_y + (row - radius) * cell_size, origin_y + (row + radius + 1) * cell_size
+            for position in self._candidates(left, top, right - 1, bottom - 1).tolist():
+                if position not in distances:
+                    distances[position] = self._distance(position, x, y)
+            found = sorted(distances, key=lambda position: (distances[position], position))[:count]
+            # Blocks that are not in the square are at least as far as its border
+            reach = min(x - left, right - x, y - top, bottom - y)
+            covers_grid = radius >= max(column, columns - 1 - column, row, rows - 1 - row)
+            if covers_grid or (len(found) == count and distances[found[-1]] <= reach):
+                return [self.ids[position] for position in found]
+            radius += 1
+
+    def adjacent(self, block_id, tolerance=ADJACENCY_TOLERANCE):
+        """Return the ids of the blocks whose outline comes within ``tolerance`` pixels of the block's."""
+        position = self.positions[block_id]
+        min_x, min_y, max_x, max_y = self.boxes[position].tolist()
+        candidates = self._candidates(min_x - tolerance, min_y - tolerance, max_x + tolerance, max_y + tolerance)
+        boxes = self.boxes[candidates]
+        near = ((boxes[:, 0] <= max_x + tolerance) & (boxes[:, 2] >= min_x - tolerance) &
+                (boxes[:, 1] <= max_y + tolerance) & (boxes[:, 3] >= min_y - tolerance) & (candidates != position))
+        outline = self._outline(position)
+        return [self.ids[other] for other in candidates[near].tolist()
+                if outline_distance(outline, self._outline(other)) <= tolerance]
+
+    def above(self, block_id, tolerance=ADJACENCY_TOLERANCE):
+        """Return the ids of the adjacent blocks whose middle is above the top of the block, on the image."""
+        top = self.boxes[self.positions[block_id], 1]
+        return [other for other in self.adjacent(block_id, tolerance) if self._middle_y(other) < top]
+
+    def below(self, block_id, tolerance=ADJACENCY_TOLERANCE):
+        """Return the ids of the adjacent blocks whose middle is below the bottom of the block, on the image."""
+        bottom = self.boxes[self.positions[block_id], 3]
+        return [other for other in self.adjacent(block_id, tolerance) if self._middle_y(other) > bottom]
+
+    def _middle_y(self, block_id):
+        _, min_y, _, max_y = self.boxes[self.positions[block_id]].tolist()
+        return (min_y + max_y) / 2
+
+    def save(self, path):
+        np.savez(path, ids=np.array(self.ids, dtype=str), boxes=self.boxes, offsets=self.offsets, points=self.points,
+                 grid=self.grid, cell_starts=self.cell_starts, cell_items=self.cell_items)
+
+
+def write_index(svg_path, paths):
+    """Index the ``SVGPath`` objects of the face of the SVG file and write the index next to it."""
+    BlockIndex.from_paths(paths).save(index_path(svg_path))
+
+
+def load_index(path):
+    """Load a block index written by ``write_index``.
+
+    For example, with ``index = load_index('input/North.index.npz')``, ``index.above('N_3_12')`` are the ids of
+    the blocks on top of block 12 of course 3, and ``index.range(0, 0, 500, 500)`` those in the top left corner.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        return BlockIndex(data['ids'].tolist(), data['boxes'], data['offsets'], data['points'], data['grid'],
+                          data['cell_starts'], data['cell_items'])
@@ -0,0 +1,74 @@
+import numpy as np
+
+# The metrics the heatmap colors the blocks by, by the viewer's name for them
+HEATMAP_METRICS = ('width', 'widthpctcrse')
+PERCENTILES = np.arange(101)
+
+
+def percentile_table(values):
+    """Return the values at the percentiles 0 to 100, picked like the viewer always did: the value at index
+    ``floor(count * percentile / 100)`` of the sorted values, and the largest value for 100."""
+    values = np.sort(np.asarray(values, dtype=np.float64))
+    if not len(values):
+        return values
+    # The same floating point product as in JavaScript, which does not always round like integer division
+    indices = np.floor(len(values) * (PERCENTILES / 100)).astype(np.int64)
+    return values[np.minimum(indices, len(values) - 1)]
+
+
+def summarize(values):
+    """Return the count, mean, standard deviation, minimum, maximum and percentile table of the values."""
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': float(values.mean()),
+        'std': float(values.std()),
+        'min': float(values.min()),
+        'max': float(values.max()),
+        'percentiles': percentile_table(values).tolist(),
+    }
+
+
+def summarize_metrics(width, width_pct_crse, is_corner):
+    """Return the summaries of both heatmap metrics, of all blocks and without the corner blocks."""
+    is_corner = np.asarray(is_corner, dtype=bool)
+    return {
+        name: {'all': summarize(values), 'without_corners': summarize(np.asarray(values)[~is_corner])}
+        for name, values in zip(HEATMAP_METRICS, (width, width_pct_crse))
+    }
+
+
+def heatmap_statistics(width, width_pct_crse, is_corner, course=None):
+    """Return the summaries of the heatmap metrics of the blocks, like
+    ``stats['width']['without_corners']['percentiles'][95]``, and with their ``course`` the same per course under
+    ``stats['courses'][course]``."""
+    statistics = summarize_metrics(width, width_pct_crse, is_corner)
+    if course is not None:
+        course = np.asarray(course)
+        order = np.argsort(course, kind='stable')
+        courses, starts = np.unique(course[order], return_index=True)
+        statistics['courses'] = {
+            int(number): summarize_metrics(*(np.asarray(column)[rows] for column in (width, width_pct_crse, is_corner)))
+            for number, rows in zip(courses, np.split(order, starts[1:]))
+        }
+    return statistics
+
+
+def table_statistics(blocks):
+    """Return the statistics of a block table, see ``block_table.load_blocks``, of all its blocks under 'corpus'
+    and of every face and its courses under 'faces'.
+
+    For example, ``table_statistics(load_blocks('input/blocks.npy'))['corpus']['width']['all']['mean']`` is the
+    average width of all blocks.
+    """
+    faces = {}
+    for face in np.unique(blocks['face']):
+        rows = blocks[blocks['face'] == face]
+        faces[face.decode('utf-8')] = heatmap_statistics(rows['width'], rows['width_pct_crse'], rows['is_corner'],
+                                                         rows['course'])
+    return {
+        'corpus': heatmap_statistics(blocks['width'], blocks['width_pct_crse'], blocks['is_corner']),
+        'faces': faces,
+    }
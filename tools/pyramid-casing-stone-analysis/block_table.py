@@ -0,0 +1,105 @@
+import io
+import os
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Optional, only needed to write the block tables as Parquet files
+    pyarrow = None
+
+# One row per block, with the face and the metrics the converter adds to the paths as typed columns
+BLOCK_COLUMNS = [
+    ('course', np.int32),
+    ('block', np.int32),
+    ('top_left_x', np.int32),
+    ('top_left_y', np.int32),
+    ('top_right_x', np.int32),
+    ('top_right_y', np.int32),
+    ('bottom_left_x', np.int32),
+    ('bottom_left_y', np.int32),
+    ('bottom_right_x', np.int32),
+    ('bottom_right_y', np.int32),
+    ('width', np.int32),
+    ('width_pct_crse', np.float64),
+    ('angle_top', np.int16),
+    ('angle_bottom', np.int16),
+    ('angle_left', np.int16),
+    ('angle_right', np.int16),
+    ('is_corner', np.bool_),
+    ('is_offloaded', np.bool_),
+]
+CORPUS_TABLE = 'blocks.npy'
+
+
+def block_dtype(face_size):
+    """Return the dtype of a block table whose face names, encoded as UTF-8, take up to ``face_size`` bytes."""
+    return np.dtype([('face', f'S{max(face_size, 1)}'), *BLOCK_COLUMNS])
+
+
+class BlockTable:
+    """The metrics of the blocks of a face, collected in block order while the attributes are computed."""
+
+    def __init__(self, face):
+        self.face = face.encode('utf-8')
+        self.rows = []
+
+    def add(self, course, block_number, corners, width, width_pct_crse, angles, is_corner, is_offloaded):
+        top_left, top_right, bottom_left, bottom_right = corners
+        self.rows.append((self.face, course, block_number, *top_left, *top_right, *bottom_left, *bottom_right, width,
+                          width_pct_crse, *angles, is_corner, is_offloaded))
+
+    def to_array(self):
+        # The face column is as wide as the name, which is never cut off
+        return np.array(self.rows, dtype=block_dtype(len(self.face)))
+
+
+def table_path(svg_path, extension='npy'):
+    """Return the path of the block table of the SVG file, like ``North.blocks.npy`` next to ``North.svg``."""
+    return f'{os.path.splitext(svg_path)[0]}.blocks.{extension}'
+
+
+def to_npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def write_table(svg_path, array, formats=('npy',)):
+    """Write the block table of the face of the SVG file in the formats, 'npy' and 'parquet'."""
+    if 'npy' in formats:
+        np.save(table_path(svg_path), array, allow_pickle=False)
+    if 'parquet' in formats:
+        if pyarrow is None:
+            raise RuntimeError("Install the pyarrow package to write the block tables as Parquet files")
+        columns = {name: array[name] for name in array.dtype.names}
+        columns['face'] = np.char.decode(array['face'], 'utf-8')
+        pyarrow.parquet.write_table(pyarrow.table(columns), table_path(svg_path, 'parquet'))
+
+
+def write_corpus_table(corpus_path, paths):
+    """Concatenate the block tables at the paths into one, one face at a time, and return its path.
+
+    The face column is as wide as the widest one of the tables.
+    """
+    tables = [np.load(path, mmap_mode='r') for path in paths]
+    face_size = max((table.dtype['face'].itemsize for table in tables), default=1)
+    corpus = np.lib.format.open_memmap(corpus_path, mode='w+', dtype=block_dtype(face_size),
+                                       shape=(sum(len(table) for table in tables),))
+    offset = 0
+    for table in tables:
+        corpus[offset:offset + len(table)] = table
+        offset += len(table)
+    corpus.flush()
+    del corpus
+    return corpus_path
+
+
+def load_blocks(path):
+    """Memory-map a block table, of one face or of the corpus, as a structured array with a field per column.
+
+    For example, with ``blocks = load_blocks('input/blocks.npy')``, ``blocks['width'][blocks['is_corner']]`` are
+    the widths of the corner blocks. Only the pages that are used are read from the file.
+    """
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,105 @@
+import os
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of the file content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(*parts):
+    """Return a hex key for the given strings, numbers and bytes."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode('utf-8')
+        # Length prefixes keep ('ab', 'c') and ('a', 'bc') apart
+        digest.update(len(part).to_bytes(8, 'little'))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class ContentCache:
+    """Files in a directory keyed by content hash, with least recently used entries evicted beyond a size cap.
+
+    Entries are written atomically, so several processes can share a cache directory. Reading an entry marks it
+    as used by updating its modification time.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Return the bytes stored for the key, or None."""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+            os.utime(path)
+        except FileNotFoundError:  # Never stored, or evicted by another process in the meantime
+            return None
+        return data
+
+    def lookup(self, key):
+        """Return the path of the entry for the key, marked as used, or None. For entries too large to read at once."""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, data):
+        with self.writer(key) as file:
+            file.write(data)
+
+    @contextmanager
+    def writer(self, key):
+        """Return a binary file to write the entry for the key to, stored once the with block completes."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as file:
+                yield file
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits its size cap."""
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
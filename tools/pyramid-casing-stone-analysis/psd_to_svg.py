@@ -1,4 +1,16 @@
 import os
+import sys
+import json
+import time
+import logging
+import argparse
+import fnmatch
+import threading
+import traceback
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
 import cv2
 import math 
 import numpy as np
@@ -8,55 +20,319 @@ import svgwrite
 from math import atan2, degrees
 import xml.etree.ElementTree as ET
 from xml.etree.ElementTree import parse
-from xml.dom.minidom import parseString
 from scipy.spatial import distance
 from bs4 import BeautifulSoup
 import re
+import io
 
-# Initialize dictionaries at the beginning of your code or function
-previous_course_bottom_row = {}
-current_course_bottom_row = {}
+import block_table
+from block_index import write_index
+from block_table import CORPUS_TABLE, BlockTable, table_path, to_npy_bytes, write_corpus_table, write_table
+from cache import ContentCache, DEFAULT_CACHE_SIZE, cache_key, file_digest
+from svg_reader import read_face
+from svg_writer import SVGPath, write_svg
 
-# New global variables
-course_width_sum = {}
-course_block_count = {}
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
 
-def sanitize_id(text):
-    return ''.join(e if e.isalnum() else '_' for e in text)
-
-
-def vectorize_blob_with_svgwrite(image, dwg, offset_x, offset_y, svg_filename, course, block_count):
-    _, thresh = cv2.threshold(image, 254, 255, cv2.THRESH_BINARY)
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    for idx, contour in enumerate(sorted(contours, key=lambda c: cv2.boundingRect(c)[0])):
-        epsilon = 0.01 * cv2.arcLength(contour, True)
-        approx_contour = cv2.approxPolyDP(contour, epsilon, True)
-        points = approx_contour.squeeze()
+log = logging.getLogger('psd_to_svg')
 
-        if np.ndim(points) > 1:
-            # Update the block count for the current course
-            block_count[course] = block_count.get(course, 0) + 1  # Update block count
+# Gray value above which a pixel belongs to a block, and the outline simplification relative to its length
+WHITE_THRESHOLD = 254
+APPROX_EPSILON = 0.01
 
-            path_id = f"path_{svg_filename[0]}_{course}_{block_count[course]}"
+# Layers decoded ahead of the one being vectorized by default, with decode workers
+DECODE_QUEUE = 2
 
-            # Unique group ID
-            group_id = f"{svg_filename[0]}_{course}_{block_count[course]}"
+# Bump when the cached contours or SVG files would come out differently for the same input
+CACHE_VERSION = 4
 
-            # Initialize group with the unique ID
-            group = dwg.g(id=group_id)
-
-            d = f'M{points[0][0] + offset_x},{points[0][1] + offset_y}'
-            for point in points[1:]:
-                d += f' L{point[0] + offset_x},{point[1] + offset_y}'
-            d += ' Z'
-
-            path = dwg.path(d=d, id=path_id, stroke='black', fill='none')
-            group.add(path)
+def sanitize_id(text):
+    return ''.join(e if e.isalnum() else '_' for e in text)
 
-            dwg.add(group)
 
-    print(f"{svg_filename[0]}_{course}_{block_count.get(course, 0)}")
+class StageTimer:
+    """Wall time and number of runs of every stage of a conversion, like decode, contours or serialization."""
+
+    def __init__(self):
+        self.stages = {}
+        # The layers may be decoded by several threads at once
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                seconds, calls = self.stages.get(name, (0.0, 0))
+                self.stages[name] = (seconds + time.perf_counter() - start, calls + 1)
+
+    def as_dict(self):
+        return {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in self.stages.items()}
+
+
+def extract_block_points(image, in_place=False, timer=None, tiler=None, components=None):
+    """Threshold the white blob image and return the simplified outline points of its blocks from left to right.
+
+    With ``in_place`` the image is thresholded in place instead of into a copy. With a ``ContourTiler``, the
+    contours of large images are found tile by tile. With a ``ComponentExtractor``, the blocks are found from the
+    connected components of the image instead.
+    """
+    timer = timer or StageTimer()
+    with timer.stage('threshold'):
+        _, thresh = cv2.threshold(image, WHITE_THRESHOLD, 255, cv2.THRESH_BINARY, dst=image if in_place else None)
+
+    with timer.stage('contours'):
+        if components is not None:
+            # Already in block order
+            contours = components.find_contours(thresh)
+        elif tiler is None:
+            contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        else:
+            contours = tiler.find_contours(thresh)
+        if components is None:
+            contours = sorted(contours, key=lambda c: cv2.boundingRect(c)[0])
+
+        block_points = []
+        for contour in contours:
+            epsilon = APPROX_EPSILON * cv2.arcLength(contour, True)
+            approx_contour = cv2.approxPolyDP(contour, epsilon, True)
+            points = approx_contour.squeeze()
+
+            if np.ndim(points) > 1:
+                block_points.append(points)
+    return block_points
+
+
+def contains(outer, inner):
+    """Whether the rectangle (x, y, w, h) ``outer`` contains the rectangle ``inner``."""
+    x, y, w, h = inner
+    outer_x, outer_y, outer_w, outer_h = outer
+    return outer_x <= x and outer_y <= y and x + w <= outer_x + outer_w and y + h <= outer_y + outer_h
+
+
+def overlaps(rect, other):
+    """Whether the rectangles (x, y, w, h) share a pixel."""
+    x, y, w, h = rect
+    other_x, other_y, other_w, other_h = other
+    return x < other_x + other_w and other_x < x + w and y < other_y + other_h and other_y < y + h
+
+
+def merge_rects(rects):
+    """Merge the rectangles (x, y, w, h) that overlap or touch, also diagonally, until none do."""
+    merged = []
+    for x, y, w, h in rects:
+        box = [x, y, x + w, y + h]
+        overlapping = True
+        while overlapping:
+            overlapping = False
+            for other in merged:
+                if other[0] <= box[2] and box[0] <= other[2] and other[1] <= box[3] and box[1] <= other[3]:
+                    merged.remove(other)
+                    box = [min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]),
+                           max(box[3], other[3])]
+                    overlapping = True
+                    break
+        merged.append(box)
+    return [(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in merged]
+
+
+class ContourTiler:
+    """Finds the external contours of large binary images tile by tile, in parallel on a thread pool.
+
+    OpenCV releases the GIL while it finds contours, so the tiles of one image are processed at the same time.
+    The blocks that touch a border between two tiles are found again in a crop of the image around the pieces
+    they were cut into, so the contours are the same, and in the same order, as those of ``cv2.findContours`` on
+    the whole image.
+    """
+
+    def __init__(self, tile_size, executor=None):
+        self.tile_size = tile_size
+        self.executor = executor
+
+    def map(self, function, items):
+        return list(self.executor.map(function, items) if self.executor is not None else map(function, items))
+
+    def find_contours(self, binary):
+        height, width = binary.shape
+        tile_size = self.tile_size
+        if max(height, width) <= tile_size:
+            return cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[0]
+
+        def area_contours(area):
+            x, y, w, h = area
+            contours, _ = cv2.findContours(binary[y:y + h, x:x + w], cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE,
+                                           offset=(x, y))
+            return [(cv2.boundingRect(contour), contour) for contour in contours]
+
+        def on_border(rect):
+            # Whether the block reaches the last row or column before a border between tiles, or the first after it
+            x, y, w, h = rect
+            border_x = min((x + w) // tile_size, (width - 1) // tile_size) * tile_size
+            border_y = min((y + h) // tile_size, (height - 1) // tile_size) * tile_size
+            return 0 < border_x >= x or 0 < border_y >= y
+
+        tiles = [(x, y, min(tile_size, width - x), min(tile_size, height - y))
+                 for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+        by_tile = self.map(area_contours, tiles)
+        pieces = [rect for tile_contours in by_tile for rect, _ in tile_contours if on_border(rect)]
+
+        # The pieces of a block cut by borders between tiles touch each other across the borders, so the merged
+        # bounding boxes of the pieces hold whole blocks, which are found again in a crop of the region. The crop
+        # is one pixel larger, so that the blocks it cuts off do not look like they fit into the region.
+        regions = merge_rects(pieces)
+        crops = [(max(x - 1, 0), max(y - 1, 0), min(x + w + 1, width) - max(x - 1, 0),
+                  min(y + h + 1, height) - max(y - 1, 0)) for x, y, w, h in regions]
+        contours = []
+        found = set()
+        for region, crop_contours in zip(regions, self.map(area_contours, crops)):
+            for rect, contour in crop_contours:
+                if contains(region, rect):
+                    found.add(tuple(contour[0, 0]))
+                    if on_border(rect):
+                        contours.append(contour)
+
+        for tile, tile_contours in zip(tiles, by_tile):
+            tile_regions = [region for region in regions if overlaps(tile, region)]
+            for rect, contour in tile_contours:
+                # A block in a hole of a block that was cut looks whole in its tile, the crop leaves it out
+                if not on_border(rect) and (tuple(contour[0, 0]) in found
+                                            or not any(contains(region, rect) for region in tile_regions)):
+                    contours.append(contour)
+
+        # cv2.findContours returns the contours by their first point, the top left pixel, bottom to top
+        contours.sort(key=lambda contour: (contour[0, 0, 1], contour[0, 0, 0]), reverse=True)
+        return contours
+
+
+class ComponentExtractor:
+    """Finds the external contours of binary images from their connected components, in block order.
+
+    One labelling of the image gives the bounding box and the area of every block, so the blocks are sorted from
+    left to right, and those smaller than ``min_area`` pixels left out, before any outline is traced. The outline
+    of every other block is then traced in its bounding box. Like ``cv2.findContours`` with ``RETR_EXTERNAL``, the
+    blocks in the holes of other blocks are left out, so the contours are the same, in the same order, as those
+    ``extract_block_points`` sorts.
+    """
+
+    def __init__(self, min_area=0, chunk_size=1024):
+        self.min_area = min_area
+        self.chunk_size = chunk_size
+
+    def find_contours(self, binary):
+        count, labels, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+        blocks = np.flatnonzero(stats[:, cv2.CC_STAT_AREA] >= self.min_area)
+        blocks = blocks[blocks != 0]  # The background
+        xs, ys, widths, heights = (stats[blocks, column] for column in
+                                   (cv2.CC_STAT_LEFT, cv2.CC_STAT_TOP, cv2.CC_STAT_WIDTH, cv2.CC_STAT_HEIGHT))
+        # The first pixel of the top row of every block, where cv2.findContours starts its contour
+        first_xs = np.array([x + np.argmax(labels[y, x:x + width] == block)
+                             for block, x, y, width in zip(blocks.tolist(), xs.tolist(), ys.tolist(), widths.tolist())],
+                            dtype=np.int64)
+
+        inside = self._inside_holes(labels, stats[1:], blocks, ys, first_xs)
+        blocks, xs, ys, widths, heights, first_xs = (column[~inside] for column in
+                                                     (blocks, xs, ys, widths, heights, first_xs))
+        # cv2.findContours returns the contours bottom to top, the blocks are sorted by their left edge from there
+        order = np.lexsort((-first_xs, -ys, xs))
+
+        contours = []
+        for index in order.tolist():
+            x, y, width, height = int(xs[index]), int(ys[index]), int(widths[index]), int(heights[index])
+            mask = np.uint8(labels[y:y + height, x:x + width] == blocks[index])
+            block_contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x, y))
+            contours.append(block_contours[0])
+        return contours
+
+    def _inside_holes(self, labels, stats, blocks, ys, first_xs):
+        """Return which of the blocks lie in a hole of another component.
+
+        A block can only be in a hole of a component whose bounding box strictly contains its own, so only those
+        pairs are checked, in the bounding box of the outer component.
+        """
+        inside = np.zeros(len(blocks), dtype=bool)
+        left, top = stats[:, cv2.CC_STAT_LEFT], stats[:, cv2.CC_STAT_TOP]
+        right, bottom = left + stats[:, cv2.CC_STAT_WIDTH], top + stats[:, cv2.CC_STAT_HEIGHT]
+        boxes = stats[blocks - 1]
+        block_left, block_top = boxes[:, cv2.CC_STAT_LEFT], boxes[:, cv2.CC_STAT_TOP]
+        block_right, block_bottom = block_left + boxes[:, cv2.CC_STAT_WIDTH], block_top + boxes[:, cv2.CC_STAT_HEIGHT]
+
+        nested = {}
+        for start in range(0, len(blocks), self.chunk_size):
+            chunk = slice(start, start + self.chunk_size)
+            contains = ((left < block_left[chunk, None]) & (top < block_top[chunk, None]) &
+                        (right > block_right[chunk, None]) & (bottom > block_bottom[chunk, None]))
+            for position, outer in zip(*np.nonzero(contains)):
+                nested.setdefault(int(outer), []).append(int(position) + start)
+
+        for outer, positions in nested.items():
+            x, y = int(left[outer]), int(top[outer])
+            outside = np.uint8(labels[y:bottom[outer], x:right[outer]] != outer + 1)
+            # The background around the outer component is the region of the padding
+            outside = cv2.copyMakeBorder(outside, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=1)
+            _, regions = cv2.connectedComponents(outside, connectivity=4)
+            positions = np.array(positions)
+            inside[positions] |= regions[ys[positions] - y + 1, first_xs[positions] - x + 1] != regions[0, 0]
+        return inside
+
+
+def pack_block_points(block_points):
+    """Serialize a list of point arrays for the cache."""
+    buffer = io.BytesIO()
+    counts = np.array([len(points) for points in block_points], dtype=np.int64)
+    points = np.concatenate(block_points) if block_points else np.empty((0, 2), dtype=np.int32)
+    np.savez(buffer, counts=counts, points=points)
+    return buffer.getvalue()
+
+
+def unpack_block_points(data):
+    with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+        counts, points = arrays['counts'], arrays['points']
+    return np.split(points, np.cumsum(counts)[:-1]) if len(counts) else []
+
+
+def vectorize_blob_with_svgwrite(image, dwg, offset_x, offset_y, svg_filename, course, block_count, course_blocks=None,
+                                 in_place=False):
+    add_block_paths(extract_block_points(image, in_place), dwg, offset_x, offset_y, svg_filename, course,
+                    block_count, course_blocks)
+
+
+def add_block_paths(block_points, dwg, offset_x, offset_y, svg_filename, course, block_count, course_blocks=None):
+    """Add a group with a path for each block outline, numbering the blocks of the course from left to right.
+
+    Without a drawing, the outlines are collected in ``course_blocks`` as ``SVGPath`` objects for ``write_svg``.
+    """
+    for points in block_points:
+        # Update the block count for the current course
+        block_count[course] = block_count.get(course, 0) + 1  # Update block count
+
+        path_id = f"path_{svg_filename[0]}_{course}_{block_count[course]}"
+
+        # Unique group ID
+        group_id = f"{svg_filename[0]}_{course}_{block_count[course]}"
+
+        if dwg is None:
+            block_points = points.astype(np.int64) + (offset_x, offset_y)
+            course_blocks.setdefault(course, []).append(SVGPath(group_id, path_id, block_count[course], block_points))
+            continue
+
+        # Initialize group with the unique ID
+        group = dwg.g(id=group_id)
+
+        d = f'M{points[0][0] + offset_x},{points[0][1] + offset_y}'
+        for point in points[1:]:
+            d += f' L{point[0] + offset_x},{point[1] + offset_y}'
+        d += ' Z'
+
+        path = dwg.path(d=d, id=path_id, stroke='black', fill='none')
+        group.add(path)
+        dwg.add(group)
+
+    log.debug("Course %s of %s has %s blocks", course, svg_filename, block_count.get(course, 0))
 
 
 def calculate_angle(point, reference_corner):
@@ -89,12 +365,59 @@ def estimate_corner_points(points):
 
         return top_left, top_right, bottom_left, bottom_right
     else:
-        print(f"Warning: Points contain an invalid tuple. Points: {points}")
+        log.warning("Points contain an invalid tuple. Points: %s", points)
         return None, None, None, None  # Return None for all corners if validation fails
 
 
-def get_course_data(points, course_data, course, is_offloaded=False):
-    top_left, top_right, bottom_left, bottom_right = estimate_corner_points(points)
+def _first_index_per_block(mask, block_ids):
+    """Return the index of the first set entry of the mask of every block, every block must have one."""
+    hits = np.flatnonzero(mask)
+    hit_blocks = block_ids[hits]
+    first = np.ones(len(hits), dtype=bool)
+    first[1:] = hit_blocks[1:] != hit_blocks[:-1]
+    return hits[first]
+
+
+def estimate_corners_and_angles(point_arrays):
+    """Estimate the corner points and the angles of the edges between them for many blocks at once.
+
+    Takes a list of ``(n, 2)`` integer point arrays as returned by ``approxPolyDP`` and returns a ``(blocks, 4, 2)``
+    array of the top left, top right, bottom left and bottom right corners and a ``(blocks, 4)`` array of the top,
+    bottom, left and right angles. The results are the same as ``estimate_corner_points`` and
+    ``round(calculate_angle(...))`` per block: a corner is the first point closest to the corner of the bounding box.
+    """
+    counts = np.fromiter((len(points) for points in point_arrays), dtype=np.intp, count=len(point_arrays))
+    points = np.concatenate(point_arrays).astype(np.int64, copy=False)
+    starts = np.zeros(len(counts), dtype=np.intp)
+    np.cumsum(counts[:-1], out=starts[1:])
+    block_ids = np.repeat(np.arange(len(counts)), counts)
+
+    xs, ys = points[:, 0], points[:, 1]
+    min_x, max_x = np.minimum.reduceat(xs, starts), np.maximum.reduceat(xs, starts)
+    min_y, max_y = np.minimum.reduceat(ys, starts), np.maximum.reduceat(ys, starts)
+
+    corners = np.empty((len(counts), 4, 2), dtype=np.int64)
+    for index, (raw_x, raw_y) in enumerate(((min_x, min_y), (max_x, min_y), (min_x, max_y), (max_x, max_y))):
+        # Squared distances are exact for integers and have the same minima as the euclidean distance
+        squared_distance = (xs - raw_x[block_ids]) ** 2 + (ys - raw_y[block_ids]) ** 2
+        closest = np.minimum.reduceat(squared_distance, starts)
+        corners[:, index] = points[_first_index_per_block(squared_distance == closest[block_ids], block_ids)]
+
+    # top: top left to top right, bottom: bottom left to bottom right, left: top left to bottom left,
+    # right: top right to bottom right, like calculate_angle(point, reference_corner)
+    deltas = corners[:, [0, 2, 0, 1]] - corners[:, [1, 3, 2, 3]]
+    degrees = np.degrees(np.arctan2(deltas[..., 1], deltas[..., 0]))
+    # NumPy's arctan2 can differ from math.atan2 in the last bit, which only matters right at a rounding boundary
+    fraction = np.abs(degrees - np.floor(degrees) - 0.5)
+    for block, edge in zip(*np.nonzero(fraction < 1e-9)):
+        degrees[block, edge] = math.degrees(math.atan2(deltas[block, edge, 1], deltas[block, edge, 0]))
+    angles = np.round(degrees).astype(np.int64)
+
+    return corners, angles
+
+
+def get_course_data(corners, course_data, course, is_offloaded=False):
+    top_left, top_right, bottom_left, bottom_right = corners
     course_data.setdefault(course, []).append({
         'top_left': top_left,
         'top_right': top_right,
@@ -104,96 +427,167 @@ def get_course_data(points, course_data, course, is_offloaded=False):
     })
 
 
-# Initialize these variables at the beginning of your script
-global_min_x = float('inf')
-global_max_x = float('-inf')
-
-# Initialize these dictionaries at the beginning of your script
-course_min_x = {}
-course_max_x = {}
-
-def update_path_attributes(path_element, points, course, block_number, course_data, total_paths):
-    global current_course_bottom_row, global_min_x, global_max_x, course_min_x, course_max_x  # Existing global declarations
-    global course_width_sum, course_block_count  # New global declarations
-    top_left, top_right, bottom_left, bottom_right = estimate_corner_points(points)
-    angle_top = round(calculate_angle(top_left, top_right))
-    angle_bottom = round(calculate_angle(bottom_left, bottom_right))
-    angle_left = round(calculate_angle(top_left, bottom_left))
-    angle_right = round(calculate_angle(top_right, bottom_right))
-
-    min_x = bottom_left[0]
-    max_x = bottom_right[0]
-    width = max_x - min_x 
-
-    # Update course-specific min and max x-coordinates
-    course_min_x[course] = min(course_min_x.get(course, float('inf')), min_x)
-    course_max_x[course] = max(course_max_x.get(course, float('-inf')), max_x)
-    course_width_sum[course] = course_width_sum.get(course, 0) + width
-    course_block_count[course] = course_block_count.get(course, 0) + 1
-    
-
-    current_course_bottom_row[block_number] = (bottom_left[0], bottom_right[0])
-    print(f"Updated current_course_bottom_row: {current_course_bottom_row}")
-    print(f"previous_course_bottom_row: {previous_course_bottom_row}")
-    print(f"top values current block: {min_x} {max_x}")
-    # New average width and width percentage calculations
-    
-    if course_block_count[course] > 0:  # Avoid division by zero
-        average_width = course_width_sum[course] / course_block_count[course]
-    else:
-        average_width = 0
-
-    if average_width > 0:  # Avoid division by zero
-        width_pct_crse = (width / average_width) * 100
-    else:
-        width_pct_crse = 0
-
-
-    is_offloaded = True  # Assume True initially
-
-    for bottom_left_x, bottom_right_x in previous_course_bottom_row.values():
-        if (min_x <= bottom_left_x <= max_x) or (min_x <= bottom_right_x <= max_x):
-            is_offloaded = False  # Set to False and exit loop if any value is within range
-            break
-        
-    # New condition: Check if there is a block at all on the previous course within the interval
-    if not any(bottom_left_x <= max_x and bottom_right_x >= min_x for bottom_left_x, bottom_right_x in previous_course_bottom_row.values()):
-        is_offloaded = False  # Set to True if no block is found within the range
-
-
-
-
-    # Update global min and max x-coordinates
-    global_min_x = min(global_min_x, min_x)
-    global_max_x = max(global_max_x, max_x)
-
-    # Check for corner block
-    is_corner = (
-        (min_x <= global_min_x or max_x >= global_max_x) and
-        (min_x <= course_min_x[course] or max_x >= course_max_x[course])
-    )      
-
-    path_element.attrib.update({
-        
-        'top_left_x': str(top_left[0]),
-        'top_right_x': str(top_right[0]),
-        'bottom_left_x': str(bottom_left[0]),
-        'bottom_right_x': str(bottom_right[0]),
-        'Width': str(width),
-        'WidthPctCrse': f'{width_pct_crse:.2f}',  # Format as a string with 2 decimal places
-        'angle_top': str(angle_top),
-        'angle_bottom': str(angle_bottom),
-        'angle_left': str(angle_left),
-        'angle_right': str(angle_right),
-        'Course': str(course),
-        'IsCorner': str(is_corner),
-        'IsOffloaded': str(is_offloaded)
-    })
-    
-        
-    get_course_data(points, course_data, course, is_offloaded)
-    
-def add_custom_attributes_with_elementtree(svg_path, svg_filename, course, course_data, block_count):
+class BottomRowIndex:
+    """Sorted index over the bottom edges of the blocks of a course for the offload test of the course above.
+
+    A block is offloaded when a block of the previous course overlaps it, while no bottom edge of the previous
+    course starts or ends within it. Both questions are answered with binary searches.
+    """
+
+    def __init__(self, bottom_row):
+        edges = np.array(list(bottom_row), dtype=np.int64).reshape(-1, 2)
+        self.endpoints = np.sort(edges.ravel())
+        order = np.argsort(edges[:, 0], kind='stable')
+        self.lefts = edges[order, 0]
+        self.max_rights = np.maximum.accumulate(edges[order, 1])
+
+    def is_offloaded(self, min_x, max_x):
+        """Return the offload flags for arrays of block bottom edges from min_x to max_x."""
+        min_x, max_x = np.asarray(min_x, dtype=np.int64), np.asarray(max_x, dtype=np.int64)
+        if not len(self.lefts):
+            return np.zeros(min_x.shape, dtype=bool)
+
+        endpoint_inside = (np.searchsorted(self.endpoints, max_x, side='right') >
+                           np.searchsorted(self.endpoints, min_x, side='left'))
+        # The edges starting at or before max_x overlap the block if the one reaching furthest right ends after min_x
+        starting_before = np.searchsorted(self.lefts, max_x, side='right')
+        overlaps = (starting_before > 0) & (self.max_rights[np.maximum(starting_before - 1, 0)] >= min_x)
+        return overlaps & ~endpoint_inside
+
+
+class CourseStats:
+    """Running x extent and width sum of the blocks of one course."""
+    __slots__ = ('min_x', 'max_x', 'width_sum', 'block_count')
+
+    def __init__(self):
+        self.min_x = float('inf')
+        self.max_x = float('-inf')
+        self.width_sum = 0
+        self.block_count = 0
+
+
+class FaceState:
+    """State of the attribute computation over the courses of one face.
+
+    The attributes of a block depend on the blocks before it, so the blocks must be passed in course and block
+    order, and ``next_course`` must be called after the last block of every course.
+    """
+
+    def __init__(self):
+        self.global_min_x = float('inf')
+        self.global_max_x = float('-inf')
+        self.courses = {}
+        self.previous_course_bottom_row = {}
+        self.previous_course_index = BottomRowIndex(())
+        self.current_course_bottom_row = {}
+        self.course_data = {}
+        # A BlockTable to collect the metrics of the blocks in, if they are exported
+        self.table = None
+
+    def compute_path_attributes(self, points, course, block_number):
+        """Compute the attributes of one block from its list of point tuples."""
+        corners = estimate_corner_points(points)
+        top_left, top_right, bottom_left, bottom_right = corners
+        angles = (
+            round(calculate_angle(top_left, top_right)),
+            round(calculate_angle(bottom_left, bottom_right)),
+            round(calculate_angle(top_left, bottom_left)),
+            round(calculate_angle(top_right, bottom_right)),
+        )
+        is_offloaded = bool(self.previous_course_index.is_offloaded(bottom_left[0], bottom_right[0]))
+        return self.block_attributes(course, block_number, corners, angles, is_offloaded)
+
+    def compute_course_attributes(self, course, block_numbers, point_arrays):
+        """Compute the attributes of all blocks of a course from their point arrays, in block order."""
+        corners, angles = estimate_corners_and_angles(point_arrays)
+        offloaded = self.previous_course_index.is_offloaded(corners[:, 2, 0], corners[:, 3, 0])
+        return [
+            self.block_attributes(course, block_number, tuple(map(tuple, block_corners)), tuple(block_angles),
+                                  is_offloaded)
+            for block_number, block_corners, block_angles, is_offloaded
+            in zip(block_numbers, corners.tolist(), angles.tolist(), offloaded.tolist())
+        ]
+
+    def block_attributes(self, course, block_number, corners, angles, is_offloaded):
+        top_left, top_right, bottom_left, bottom_right = corners
+        angle_top, angle_bottom, angle_left, angle_right = angles
+
+        min_x = bottom_left[0]
+        max_x = bottom_right[0]
+        width = max_x - min_x
+
+        # Update course-specific min and max x-coordinates and the running width sum
+        stats = self.courses.get(course)
+        if stats is None:
+            stats = self.courses[course] = CourseStats()
+        stats.min_x = min(stats.min_x, min_x)
+        stats.max_x = max(stats.max_x, max_x)
+        stats.width_sum += width
+        stats.block_count += 1
+
+        self.current_course_bottom_row[block_number] = (bottom_left[0], bottom_right[0])
+
+        # Average width and width percentage of the blocks of the course so far
+        average_width = stats.width_sum / stats.block_count
+        if average_width > 0:  # Avoid division by zero
+            width_pct_crse = (width / average_width) * 100
+        else:
+            width_pct_crse = 0
+
+        # Update global min and max x-coordinates
+        self.global_min_x = min(self.global_min_x, min_x)
+        self.global_max_x = max(self.global_max_x, max_x)
+
+        # Check for corner block
+        is_corner = (
+            (min_x <= self.global_min_x or max_x >= self.global_max_x) and
+            (min_x <= stats.min_x or max_x >= stats.max_x)
+        )
+
+        attributes = {
+            'top_left_x': str(top_left[0]),
+            'top_right_x': str(top_right[0]),
+            'bottom_left_x': str(bottom_left[0]),
+            'bottom_right_x': str(bottom_right[0]),
+            'Width': str(width),
+            'WidthPctCrse': f'{width_pct_crse:.2f}',  # Format as a string with 2 decimal places
+            'angle_top': str(angle_top),
+            'angle_bottom': str(angle_bottom),
+            'angle_left': str(angle_left),
+            'angle_right': str(angle_right),
+            'Course': str(course),
+            'IsCorner': str(is_corner),
+            'IsOffloaded': str(is_offloaded)
+        }
+
+        get_course_data(corners, self.course_data, course, is_offloaded)
+        if self.table is not None:
+            self.table.add(course, block_number, corners, width, width_pct_crse, angles, is_corner, is_offloaded)
+
+        return attributes
+
+    def add_bottom_row(self, point_arrays):
+        """Add the bottom edges of blocks that are not converted themselves to the current course, for the offload
+        test of the next course."""
+        if point_arrays:
+            corners, _ = estimate_corners_and_angles(point_arrays)
+            # Under negative numbers, apart from the blocks of the course that are converted
+            self.current_course_bottom_row.update(zip(range(-1, -len(point_arrays) - 1, -1),
+                                                      map(tuple, corners[:, 2:, 0].tolist())))
+
+    def next_course(self):
+        """Make the bottom row of the current course the one the next course is compared against."""
+        log.debug("Comparing the next course with %s bottom edges", len(self.current_course_bottom_row))
+        self.previous_course_bottom_row = self.current_course_bottom_row
+        self.previous_course_index = BottomRowIndex(self.previous_course_bottom_row.values())
+        self.current_course_bottom_row = {}
+
+
+def update_path_attributes(path_element, points, course, block_number, state, total_paths):
+    path_element.attrib.update(state.compute_path_attributes(points, course, block_number))
+
+
+def add_custom_attributes_with_elementtree(svg_path, svg_filename, course, state, block_count):
     tree = ET.parse(svg_path)
     root = tree.getroot()
 
@@ -202,95 +596,269 @@ def add_custom_attributes_with_elementtree(svg_path, svg_filename, course, cours
         group = root.find(f".//{{http://www.w3.org/2000/svg}}g[@id='{group_id}']")
         
         if group is not None:
-            print(f"ID Matching: Match found for Group ID: {group_id}")
-
             total_paths = len(group.findall(".//{http://www.w3.org/2000/svg}path"))
-      
+
             for idx, path_element in enumerate(group.findall(".//{http://www.w3.org/2000/svg}path")):
-                print("Attribute Update: Updating attributes for path elements.")
                 d_value = path_element.attrib['d']
                 parsed_d_values = d_value.replace('M', '').replace('Z', '').split('L')
                 points = [tuple(map(int, value.split(','))) for value in parsed_d_values]
 
                 # Pass the block_number i as an argument here
-                update_path_attributes(path_element, points, course, i, course_data, total_paths)
+                update_path_attributes(path_element, points, course, i, state, total_paths)
 
-            print("File Write-back: Writing back to SVG.")
             tree.write(svg_path)
-            print("File Write-back: Successfully wrote back to SVG.")
         else:
-            print(f"ID Matching: Group with ID {group_id} not found.")
-
-
-
-     
-# Ensure each <path> element is individually selectable
-def post_process_svg(svg_path):
-    with open(svg_path, 'r') as file:
-        svg_str = file.read()
-
-    dom = parseString(svg_str)
-    paths = dom.getElementsByTagNameNS('http://www.w3.org/2000/svg', 'path')
-    groups = dom.getElementsByTagNameNS('http://www.w3.org/2000/svg', 'g')
-
-    for path in paths:
-        path.setAttribute('pointer-events', 'all')
-
-    for group in groups:
-        group.setAttribute('pointer-events', 'all')
-
-    with open(svg_path, 'w') as file:
-        file.write(dom.toprettyxml())
-# Note: Keep the remaining parts of the code unchanged.
-
-previous_course_bottom_row, current_course_bottom_row = None, None  # Initial global assignment
-
-def reset_course_bottom_rows():
-    global previous_course_bottom_row, current_course_bottom_row
-    # The global declaration is done before any assignments.
-    previous_course_bottom_row, current_course_bottom_row = {}, {}
-
-
-def reset_global_max():
-    global global_max_x, global_min_x, course_min_x, course_max_x
-    global_max_x, global_min_x = float('-inf'), float('inf')
-    course_min_x, course_max_x = {}, {}  # Resetting course-specific min and max x-coordinates
-
-
-
-def process_psd(psd_path, svg_path):
-    global previous_course_bottom_row, current_course_bottom_row, global_max_x, global_min_x
-    reset_course_bottom_rows()  # Resets the course bottom rows.
-    reset_global_max()          # Resets the global and course-specific max variables.
-    print("Inside process_psd: Starting.")
-    psd = PSDImage.open(psd_path)
-    dwg = svgwrite.Drawing(svg_path, size=(psd.width, psd.height), profile='tiny')
-    svg_filename = os.path.basename(svg_path).split('.')[0]
-    course_data = {}
-    course = 0
-    block_count = {}  # Initialize block_count as an empty dictionary
-    walk_layers(psd, dwg, svg_filename, course, course_data, block_count)  # Include block_count in function call
-    
-    dwg.save()
-    print(f"Inside process_psd: Saved SVG. Course data: {course_data}")
-    
-    for course in range(1, len(block_count) + 1):  # Loop through each course
-        print(f"Inside process_psd: Trying to call add_custom_attributes_with_elementtree for course {course}.")
-        print("Type of count before calling add_custom_attributes_with_elementtree:", type(block_count[course]))
-        print("Value of count:", block_count[course])
-        add_custom_attributes_with_elementtree(svg_path, svg_filename, course, course_data, block_count)  # Passing specific block_count for the course
-    
-        # Moved this block of code here, after all layers have been processed
-        global previous_course_bottom_row, current_course_bottom_row
-        print(f"previous_course_bottom_row before flush: {previous_course_bottom_row}")
-        print(f"current_course_bottom_row before flush: {current_course_bottom_row}")
-        # Move current to previous and clear current
-        previous_course_bottom_row = current_course_bottom_row
-        current_course_bottom_row = {}
-        print(f"previous_course_bottom_row after flush: {previous_course_bottom_row}")
-        print(f"current_course_bottom_row after flush: {current_course_bottom_row}")
-        
-        print("Inside process_psd: Exiting.")
+            log.warning("Group with ID %s not found", group_id)
+
+
+def add_custom_attributes_in_memory(course, state, course_blocks):
+    """Set the custom attributes of one course on the ``SVGPath`` objects collected while vectorizing."""
+    paths = course_blocks.get(course)
+    if not paths:
+        return
+
+    block_numbers = [path.block_number for path in paths]
+    point_arrays = [path.points for path in paths]
+    for path, attributes in zip(paths, state.compute_course_attributes(course, block_numbers, point_arrays)):
+        path.attributes.update(attributes)
+
+
+@dataclass
+class ConversionResult:
+    psd_path: str
+    svg_path: str
+    seconds: float
+    error: str = None
+    block_count: dict = None
+    course_data: dict = None
+    peak_memory_mb: float = None
+    cached: bool = False
+    stages: dict = None
+
+
+def peak_memory_mb():
+    """Return the peak resident memory of this process in MiB, since the last ``reset_peak_memory`` where that
+    worked, or None where it cannot be measured."""
+    try:
+        with open('/proc/self/status', encoding='ascii') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def reset_peak_memory():
+    """Start measuring the peak memory of this process anew and return whether that worked, which it only does on
+    Linux. Otherwise the peak memory stays the peak of the whole process so far."""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='ascii') as file:
+            file.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def conversion_peak_memory_mb(measured):
+    """Return the peak memory since the start of the conversion, if it could be measured from there."""
+    return peak_memory_mb() if measured else None
+
+
+class PSDConverter:
+    """Converts PSD files to SVG files with custom attributes.
+
+    The converter only holds its settings. Every conversion keeps its state to itself, so a single converter can
+    convert any number of files, one after another or concurrently from several threads. The peak memory of a
+    conversion is that of its process from its start on, so concurrent conversions in one process share it.
+
+    With ``single_pass`` the attributes are computed in memory from the contour points and the SVG is written
+    once by ``write_svg``, ``compact`` and with the coordinates rounded to a grid of ``quantize`` pixels if given.
+    Otherwise the SVG is saved with svgwrite first and re-parsed and rewritten once per course.
+
+    With ``low_memory`` every layer is decoded to a single RGBA copy within its bounding box, which is released
+    as soon as the layer is thresholded into buffers that are reused for all layers of the file.
+
+    With a ``cache_dir`` the SVG files are cached by the content of the PSD files, and the block outlines of
+    every layer by its pixel data, so only the layers that changed since the last run are vectorized again.
+
+    With a ``tile_size``, the contours of layers larger than that are found in tiles of that many pixels, by
+    ``tile_workers`` threads, see ``ContourTiler``. The output is the same.
+
+    With the 'components' ``extraction``, the blocks are found from the connected components of every layer, see
+    ``ComponentExtractor``, and the blocks smaller than ``min_block_area`` pixels are left out. Without a minimum
+    area, the output is the same as with the default 'contours'.
+
+    With ``decode_workers`` threads, the next ``decode_queue`` layers are read from the cache or decoded while
+    the current one is vectorized, see ``walk_layers_pipelined``. The output is the same.
+
+    A ``LayerSelection`` restricts the conversion to some of the layers, the others are not decoded.
+
+    ``tables`` may contain 'npy' and 'parquet' to also write the metrics of the blocks as a table next to the SVG
+    file, like ``North.blocks.npy``, see ``block_table``. With ``index``, a spatial index of the blocks is written
+    next to the SVG file too, like ``North.index.npz``, see ``block_index``.
+
+    With ``course_data``, the result also has the corners of every block by course. It is left out by default, as
+    the results of a batch are sent back from the worker processes and kept until the batch is done; the block
+    tables have the same data.
+    """
+
+    def __init__(self, single_pass=True, low_memory=False, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+                 compact=False, quantize=None, tile_size=None, tile_workers=None, tables=(),
+                 index=False, decode_workers=None, decode_queue=DECODE_QUEUE, selection=None, extraction='contours',
+                 min_block_area=0, course_data=False):
+        self.single_pass = single_pass
+        self.compact = compact
+        self.quantize = quantize
+        self.low_memory = low_memory
+        self.cache = ContentCache(cache_dir, cache_size) if cache_dir else None
+        self.tile_size = tile_size
+        self.tile_workers = tile_workers
+        self.tables = tables
+        self.index = index
+        self.decode_workers = decode_workers
+        self.decode_queue = decode_queue
+        self.selection = selection
+        self.extraction = extraction
+        self.min_block_area = min_block_area
+        self.course_data = course_data
+
+    def convert(self, psd_path, svg_path=None):
+        """Convert the PSD file, by default to an SVG file next to it, and return a ``ConversionResult``."""
+        if svg_path is None:
+            svg_path = os.path.splitext(psd_path)[0] + '.svg'
+
+        start = time.perf_counter()
+        measured = reset_peak_memory()
+        timer = StageTimer()
+        log.info("Converting %s", psd_path)
+        svg_filename = os.path.basename(svg_path).split('.')[0]
+
+        if self.cache is not None:
+            with timer.stage('cache'):
+                face_key = cache_key('face', CACHE_VERSION, WHITE_THRESHOLD, APPROX_EPSILON, self.single_pass,
+                                     self.compact, self.quantize, svg_filename, file_digest(psd_path),
+                                     *([self.selection.key()] if self.selection else []),
+                                     *([self.min_block_area] if self.extraction == 'components' and self.min_block_area
+                                       else []))
+                svg_data = self.cache.get(face_key)
+                table_key = cache_key(face_key, 'blocks')
+                table_data = self.cache.get(table_key) if self.tables and svg_data is not None else None
+            if svg_data is not None and (table_data is not None or not self.tables):
+                log.info("%s is unchanged, using the cached SVG", psd_path)
+                with timer.stage('serialization'):
+                    with open(svg_path, 'wb') as file:
+                        file.write(svg_data)
+                    if self.tables:
+                        write_table(svg_path, np.load(io.BytesIO(table_data), allow_pickle=False), self.tables)
+                    if self.index:
+                        write_index(svg_path, read_face(svg_path).paths)
+                return ConversionResult(psd_path, svg_path, time.perf_counter() - start,
+                                        peak_memory_mb=conversion_peak_memory_mb(measured), cached=True,
+                                        stages=timer.as_dict())
+
+        with timer.stage('decode'):
+            psd = PSDImage.open(psd_path)
+            if self.low_memory:
+                release_pixel_data(psd)
+        dwg = None if self.single_pass else svgwrite.Drawing(svg_path, size=(psd.width, psd.height), profile='tiny')
+        conversion = Conversion(dwg, svg_filename, self.single_pass, LayerBuffers() if self.low_memory else None,
+                                self.cache, timer)
+        conversion.selection = self.selection
+        if self.selection is not None and self.selection.skips_earlier_layers(psd):
+            log.warning("Converting only some of the layers of %s: the corner flags are computed from the converted "
+                        "blocks and may differ from those of the whole face", psd_path)
+        if self.extraction == 'components':
+            conversion.components = ComponentExtractor(self.min_block_area)
+        if self.tables:
+            conversion.state.table = BlockTable(svg_filename)
+        with (ThreadPoolExecutor(self.tile_workers) if self.tile_size else nullcontext() as executor,
+              ThreadPoolExecutor(self.decode_workers) if self.decode_workers else nullcontext() as decoder):
+            if self.tile_size:
+                conversion.tiler = ContourTiler(self.tile_size, executor)
+            if self.decode_workers:
+                walk_layers_pipelined(psd, conversion, decoder, self.decode_queue)
+            else:
+                walk_layers(psd, conversion)
+        conversion.buffers = None
+        state, block_count = conversion.state, conversion.block_count
+
+        if not self.single_pass:
+            with timer.stage('serialization'):
+                dwg.save()
+
+        for course in range(1, len(block_count) + 1):  # Loop through each course
+            with timer.stage('attributes'):
+                if self.single_pass:
+                    add_custom_attributes_in_memory(course, state, conversion.course_blocks)
+                else:
+                    add_custom_attributes_with_elementtree(svg_path, svg_filename, course, state, block_count)
+                if course in conversion.context_blocks:
+                    state.add_bottom_row([path.points for path in conversion.context_blocks[course]])
+                state.next_course()
+
+        if self.single_pass:
+            with timer.stage('serialization'):
+                paths = (path for course_paths in conversion.course_blocks.values() for path in course_paths)
+                write_svg(svg_path, psd.width, psd.height, paths, self.compact, self.quantize)
+
+        if self.tables:
+            with timer.stage('serialization'):
+                table = conversion.state.table.to_array()
+                write_table(svg_path, table, self.tables)
+
+        if self.index:
+            with timer.stage('serialization'):
+                # The outlines in memory are those in the file, unless they were rounded to a grid
+                if self.single_pass and not self.quantize:
+                    write_index(svg_path, [path for course_paths in conversion.course_blocks.values()
+                                           for path in course_paths])
+                else:
+                    write_index(svg_path, read_face(svg_path).paths)
+
+        if self.cache is not None:
+            with timer.stage('cache'):
+                with open(svg_path, 'rb') as file:
+                    self.cache.put(face_key, file.read())
+                if self.tables:
+                    self.cache.put(table_key, to_npy_bytes(table))
+                self.cache.evict()
+
+        log.info("Saved %s with %s blocks in %s courses", svg_path, sum(block_count.values()), len(block_count))
+        return ConversionResult(psd_path, svg_path, time.perf_counter() - start, block_count=block_count,
+                                course_data=state.course_data if self.course_data else None,
+                                peak_memory_mb=conversion_peak_memory_mb(measured), stages=timer.as_dict())
+
+
+class Conversion:
+    """The drawing or the collected paths and the running state of the conversion of one PSD file, shared while
+    walking its layers."""
+
+    def __init__(self, dwg, svg_filename, single_pass=True, buffers=None, cache=None, timer=None):
+        self.dwg = dwg
+        self.svg_filename = svg_filename
+        self.state = FaceState()
+        self.block_count = {}
+        # The paths and contour points of every course, to compute the attributes without re-parsing the SVG
+        self.course_blocks = {} if single_pass else None
+        self.buffers = buffers
+        self.cache = cache
+        self.timer = timer or StageTimer()
+        self.tiler = None
+        self.components = None
+        self.selection = None
+        # The blocks of the courses below the selected ones, which are only compared against
+        self.context_blocks = {}
+        self.context_count = {}
+
+
+def process_psd(psd_path, svg_path, single_pass=True):
+    """Convert a PSD file to an SVG file with custom attributes."""
+    return PSDConverter(single_pass, course_data=True).convert(psd_path, svg_path)
 
 
 def numeric_sort(groups):
@@ -298,50 +866,452 @@ def numeric_sort(groups):
     numeric_part = lambda group: int(re.sub("[^0-9]", "", group.name) or 0)
     return sorted(groups, key=numeric_part)
 
-def walk_layers(psd, dwg, svg_filename, course, course_data, block_count):
-    global previous_course_bottom_row, current_course_bottom_row
-    
+def iter_layers(psd, course=0):
+    """Yield the groups and layers of the document with their course, in the order the blocks are numbered in."""
     groups = [layer for layer in psd if layer.is_group()]
     sorted_groups = numeric_sort(groups)
-    
+
     for layer in sorted_groups + [layer for layer in psd if not layer.is_group()]:
         if layer.is_group():
             course += 1
-            block_count[course] = 0
-            walk_layers(layer, dwg, svg_filename, course, course_data, block_count)
+            yield layer, course
+            yield from iter_layers(layer, course)
         else:
-            process_layer(layer, dwg, svg_filename, course, course_data, block_count)
+            yield layer, course
+
+
+class LayerSelection:
+    """The layers to convert: those of the given courses, of groups with a name matching one of the patterns, and
+    only the visible ones. The courses keep the numbers they have in the whole document.
+
+    The blocks of a course are compared with those of the course below it for the offload test, so all other
+    layers of the courses below those with selected layers are vectorized as well, as their context, but not
+    converted.
+    """
+
+    def __init__(self, courses=None, groups=None, visible_only=False):
+        self.courses = set(courses) if courses else None
+        self.groups = list(groups or ())
+        self.visible_only = visible_only
+
+    def key(self):
+        return sorted(self.courses or ()), self.groups, self.visible_only
+
+    def includes(self, layer, course):
+        if self.visible_only and not layer.is_visible():
+            return False
+        if self.courses is not None and course not in self.courses:
+            return False
+        return not self.groups or any(fnmatch.fnmatchcase(name, pattern) for name in group_names(layer)
+                                      for pattern in self.groups)
+
+    def context_courses(self, psd):
+        """Return the courses right below those with selected layers, whatever selected them."""
+        return {course - 1 for layer, course in iter_layers(psd)
+                if not layer.is_group() and course > 1 and self.includes(layer, course)}
+
+    def skips_earlier_layers(self, psd):
+        """Return whether layers of the courses up to the last selected one are left out, which the corner flags
+        of the selected blocks depend on."""
+        layers = [(layer, course) for layer, course in iter_layers(psd) if not layer.is_group()]
+        last_course = max((course for layer, course in layers if self.includes(layer, course)), default=0)
+        return any(course <= last_course and not self.includes(layer, course) for layer, course in layers)
+
+
+def group_names(layer):
+    """Return the names of the groups the layer is in, innermost first."""
+    names = []
+    parent = layer.parent
+    while parent is not None and parent.kind == 'group':
+        names.append(parent.name)
+        parent = parent.parent
+    return names
+
+
+def selected_layers(psd, selection=None):
+    """Return the groups and the selected layers of the document, and the layers of their context courses, with
+    their course, see ``iter_layers``."""
+    if selection is None:
+        return list(iter_layers(psd))
+    context_courses = selection.context_courses(psd)
+    return [(layer, course) for layer, course in iter_layers(psd)
+            if layer.is_group() or course in context_courses or selection.includes(layer, course)]
+
+
+def list_layers(psd_path, selection=None):
+    """Return the courses and layers of the PSD file as lines of text, from the layer records alone, without
+    decoding any pixels."""
+    psd = PSDImage.open(psd_path)
+    lines = [f"{psd_path} ({psd.width}x{psd.height})"]
+    context_courses = selection.context_courses(psd) if selection is not None else set()
+    for layer, course in iter_layers(psd):
+        indent = '  ' * (len(group_names(layer)) + 1)
+        hidden = '' if layer.is_visible() else ', hidden'
+        if layer.is_group():
+            lines.append(f"{indent}course {course}: {layer.name}{hidden}")
+        else:
+            skipped = ''
+            if selection is not None and not selection.includes(layer, course):
+                skipped = ', context' if course in context_courses else ', skipped'
+            lines.append(f"{indent}{layer.name}: {layer.width}x{layer.height} at {layer.left},{layer.top}"
+                         f"{hidden}{skipped}")
+    return lines
 
 
-def process_layer(layer, dwg, svg_filename, course, course_data, block_count):
-    print(f"Inside process_layer: Layer {layer.name}, Course {course}, Block Count: {block_count}")
-   
-    pil_image = layer.topil()
-    rgba_image = cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGBA2BGRA)
-    alpha_channel = rgba_image[:, :, 3]
-    white_channel = cv2.cvtColor(rgba_image, cv2.COLOR_BGRA2GRAY)
-    white_blob = cv2.bitwise_and(white_channel, white_channel, mask=alpha_channel)
-    x, y = layer.left, layer.top
-    vectorize_blob_with_svgwrite(white_blob, dwg, x, y, svg_filename, course, block_count)  # Corrected number of arguments
-    # Assuming course_data is updated here. Add debug info.
-    print(f"Before updating course_data: {course_data}")
-    # Code that updates course_data
-    print(f"After updating course_data: {course_data}")
+def walk_layers(psd, conversion):
+    for layer, course in selected_layers(psd, conversion.selection):
+        if layer.is_group():
+            conversion.block_count[course] = 0
+        else:
+            process_layer(layer, conversion, course)
+
+
+def walk_layers_pipelined(psd, conversion, executor, depth):
+    """Like ``walk_layers``, with the upcoming layers read from the cache or decoded by the threads of the executor
+    while the current one is vectorized.
+
+    At most ``depth`` layers are read ahead of the current one, which caps the memory their decoded pixels take.
+    The layers are still vectorized one at a time and in document order, so the blocks are numbered the same.
+    """
+    depth = max(depth, 0)  # The current layer is always read
+    layers = selected_layers(psd, conversion.selection)
+    upcoming = (layer for layer, _ in layers if not layer.is_group())
+    reading = deque()
+
+    def read_ahead():
+        while len(reading) <= depth:
+            layer = next(upcoming, None)
+            if layer is None:
+                return
+            reading.append(executor.submit(read_layer, layer, conversion.cache, conversion.timer,
+                                           components=conversion.components))
+
+    for layer, course in layers:
+        if layer.is_group():
+            conversion.block_count[course] = 0
+            continue
+        read_ahead()
+        process_layer(layer, conversion, course, reading.popleft().result())
+
+
+class LayerBuffers:
+    """Grayscale and mask buffers shared by the layers of a conversion, grown to fit the largest layer so far."""
+
+    def __init__(self):
+        self.gray = np.empty(0, dtype=np.uint8)
+        self.mask = np.empty(0, dtype=np.uint8)
+
+    def get(self, height, width):
+        size = height * width
+        if self.gray.size < size:
+            self.gray = np.empty(size, dtype=np.uint8)
+            self.mask = np.empty(size, dtype=np.uint8)
+        return self.gray[:size].reshape(height, width), self.mask[:size].reshape(height, width)
+
+
+def release_pixel_data(psd_or_layer):
+    """Drop the encoded pixel data psd_tools keeps in memory for the merged image of a document or for a layer.
+
+    psd_tools reads the whole file up front. The conversion never looks at the merged image, and it only needs
+    the channels of a layer until the layer is vectorized, so in low memory mode both are released early.
+    """
+    image_data = getattr(getattr(psd_or_layer, '_record', None), 'image_data', None)
+    if image_data is not None:
+        image_data.data = b''
+    for channel in getattr(psd_or_layer, '_channels', None) or ():
+        channel.data = b''
+
+
+def decode_layer(layer):
+    """Decode the pixels of the layer to an RGBA array."""
+    return np.asarray(layer.topil())
+
+
+def white_blob_low_memory(rgba_image, buffers):
+    """Return the white opaque pixels of the RGBA image as a binary image that lives in the shared buffers."""
+    gray, mask = buffers.get(*rgba_image.shape[:2])
+    cv2.cvtColor(rgba_image, cv2.COLOR_RGBA2GRAY, dst=gray)
+    cv2.threshold(rgba_image[:, :, 3], 0, 255, cv2.THRESH_BINARY, dst=mask)
+
+    # Same as thresholding the gray image masked by the alpha channel, without the masked copy
+    cv2.threshold(gray, WHITE_THRESHOLD, 255, cv2.THRESH_BINARY, dst=gray)
+    cv2.bitwise_and(gray, mask, dst=gray)
+    return gray
+
+
+def layer_block_points(layer, buffers=None, timer=None, tiler=None, rgba_image=None, components=None):
+    """Decode the layer, unless its pixels are given as ``rgba_image``, and return the outline points of its blocks,
+    relative to the top left of the layer."""
+    timer = timer or StageTimer()
+    if rgba_image is None:
+        with timer.stage('decode'):
+            rgba_image = decode_layer(layer)
+
+    if buffers is not None:
+        with timer.stage('decode'):
+            white_blob = white_blob_low_memory(rgba_image, buffers)
+        del rgba_image
+        return extract_block_points(white_blob, in_place=True, timer=timer, tiler=tiler, components=components)
+
+    with timer.stage('decode'):
+        rgba_image = cv2.cvtColor(rgba_image, cv2.COLOR_RGBA2BGRA)
+        alpha_channel = rgba_image[:, :, 3]
+        white_channel = cv2.cvtColor(rgba_image, cv2.COLOR_BGRA2GRAY)
+        white_blob = cv2.bitwise_and(white_channel, white_channel, mask=alpha_channel)
+    return extract_block_points(white_blob, timer=timer, tiler=tiler, components=components)
+
+
+def layer_cache_key(layer, components=None):
+    """Return the cache key of the block outlines of a layer, from its encoded channel data and its position, and
+    the minimum area of the blocks of the ``ComponentExtractor`` if it leaves any out."""
+    parts = ['layer', CACHE_VERSION, WHITE_THRESHOLD, APPROX_EPSILON, layer.left, layer.top, layer.width, layer.height]
+    if components is not None and components.min_area:
+        parts.append(components.min_area)
+    channels = getattr(layer, '_channels', None)
+    if channels is None:
+        # Hashing the encoded channels saves decoding layers that are cached, fall back to the decoded pixels
+        parts.append(layer.topil().tobytes())
+    else:
+        for channel in channels:
+            parts += [int(channel.compression), channel.data]
+    return cache_key(*parts)
+
+
+def read_layer(layer, cache=None, timer=None, decode=True, components=None):
+    """Return the cache key of the layer and its cached block points or, if it is not cached, its decoded pixels.
+
+    Without ``decode``, the pixels are left for ``layer_block_points`` to decode.
+    """
+    timer = timer or StageTimer()
+    key = None
+    if cache is not None:
+        with timer.stage('cache'):
+            key = layer_cache_key(layer, components)
+            data = cache.get(key)
+            if data is not None:
+                log.debug("Using the cached blocks of layer %s", layer.name)
+                return key, unpack_block_points(data), None
+
+    if not decode:
+        return key, None, None
+    with timer.stage('decode'):
+        return key, None, decode_layer(layer)
+
+
+def process_layer(layer, conversion, course, loaded=None):
+    """Add the blocks of the layer to the conversion, from what ``read_layer`` returned for it if given."""
+    log.debug("Processing layer %s of course %s", layer.name, course)
+    cache, timer = conversion.cache, conversion.timer
+
+    key, block_points, rgba_image = loaded or read_layer(layer, cache, timer, decode=False,
+                                                         components=conversion.components)
+    if block_points is None:
+        block_points = layer_block_points(layer, conversion.buffers, timer, conversion.tiler, rgba_image,
+                                          conversion.components)
+        if cache is not None:
+            with timer.stage('cache'):
+                cache.put(key, pack_block_points(block_points))
+
+    if conversion.buffers is not None:
+        release_pixel_data(layer)
+
+    with timer.stage('vectorize'):
+        # Only the selected layers and those of their context courses are walked
+        if conversion.selection is not None and not conversion.selection.includes(layer, course):
+            add_block_paths(block_points, None, layer.left, layer.top, conversion.svg_filename, course,
+                            conversion.context_count, conversion.context_blocks)
+        else:
+            add_block_paths(block_points, conversion.dwg, layer.left, layer.top, conversion.svg_filename, course,
+                            conversion.block_count, conversion.course_blocks)
 
 
-def main():
-    print("Starting main function.")
-    block_count = [0]
-    input_folder = './input'
+def parse_courses(text):
+    """Return the courses of a course number or range, like ``3`` or ``5-7``."""
+    first, _, last = text.partition('-')
+    courses = list(range(int(first), int(last or first) + 1))
+    if not courses:
+        raise argparse.ArgumentTypeError(f"the course range {text} is empty, the first course must come first")
+    return courses
+
+
+def find_psd_files(input_folder):
+    """Return the (psd_path, svg_path) pairs of all PSD files below the input folder."""
+    jobs = []
     for root, _, files in os.walk(input_folder):
         for filename in files:
             if filename.endswith('.psd'):
-                print(f"Processing PSD file: {filename}")
                 psd_path = os.path.join(root, filename)
                 svg_filename = f"{filename.split('.')[0]}.svg"
-                svg_path = os.path.join(root, svg_filename)
-                process_psd(psd_path, svg_path)
-    print("Main function execution complete.")
+                jobs.append((psd_path, os.path.join(root, svg_filename)))
+    return jobs
+
+
+def convert_psd(psd_path, svg_path, converter=None):
+    """Convert one PSD file and report the time it took, or the error it failed with."""
+    start = time.perf_counter()
+    measured = reset_peak_memory()
+    try:
+        return (converter or PSDConverter()).convert(psd_path, svg_path)
+    except Exception:
+        return ConversionResult(psd_path, svg_path, time.perf_counter() - start, traceback.format_exc(),
+                                peak_memory_mb=conversion_peak_memory_mb(measured))
+
+
+def configure_logging(level=logging.INFO):
+    logging.basicConfig(level=level, format='%(message)s')
+
+
+def conversion_pool(workers=None):
+    # Workers started with spawn do not inherit the logging setup
+    return ProcessPoolExecutor(max_workers=workers, initializer=configure_logging,
+                               initargs=(log.getEffectiveLevel(),))
+
+
+def convert_batch(jobs, workers=None, converter=None, executor=None):
+    """Convert the (psd_path, svg_path) pairs in a pool of worker processes.
+
+    Every conversion has its own state, so a worker can safely take on several files. A single worker converts
+    the files in the current process. An ``executor`` from ``conversion_pool`` is used instead of a new pool, so
+    that its workers, with their imports loaded, can take on several batches.
+    """
+    if executor is None:
+        if workers == 1 or len(jobs) <= 1:
+            return [convert_psd(psd_path, svg_path, converter) for psd_path, svg_path in jobs]
+        with conversion_pool(workers) as executor:
+            return convert_batch(jobs, converter=converter, executor=executor)
+
+    futures = [executor.submit(convert_psd, psd_path, svg_path, converter) for psd_path, svg_path in jobs]
+    return [future.result() for future in futures]
+
+
+def print_summary(results, seconds):
+    failures = [result for result in results if result.error]
+    log.info("Converted %s of %s PSD files in %.2fs:", len(results) - len(failures), len(results), seconds)
+    for result in results:
+        status = 'FAILED' if result.error else 'cached' if result.cached else 'ok'
+        memory = f", peak memory {result.peak_memory_mb:.0f} MiB" if result.peak_memory_mb is not None else ''
+        log.info("  %s: %s (%.2fs%s)", os.path.basename(result.psd_path), status, result.seconds, memory)
+    for result in failures:
+        log.error("Error while converting %s:\n%s", result.psd_path, result.error)
+
+
+def write_timings(path, results, seconds):
+    """Write the time spent in every stage, per file and in total, as JSON."""
+    totals = {}
+    for result in results:
+        for name, stage in (result.stages or {}).items():
+            total = totals.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            total['seconds'] += stage['seconds']
+            total['calls'] += stage['calls']
+
+    timings = {
+        'seconds': seconds,
+        'stages': totals,
+        'files': {
+            result.psd_path: {
+                'seconds': result.seconds,
+                'peak_memory_mb': result.peak_memory_mb,
+                'cached': result.cached,
+                'failed': result.error is not None,
+                'stages': result.stages or {},
+            }
+            for result in results
+        },
+    }
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(timings, file, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the PSD files in the input folder to SVG files.")
+    parser.add_argument('--input', default='./input', help="folder to search for PSD files (default: ./input)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('--low-memory', action='store_true',
+                        help="decode and threshold one layer at a time into reused buffers to keep the peak memory low")
+    parser.add_argument('--cache-dir',
+                        help="cache the SVG files and the blocks of every layer in this folder, so that unchanged "
+                             "files and layers are not vectorized again")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help="size of the cache in MiB, least recently used entries are evicted beyond it "
+                             "(default: %(default)s)")
+    parser.add_argument('--compact', action='store_true',
+                        help="write the SVG files without line breaks and indentation")
+    parser.add_argument('--quantize', type=int,
+                        help="round the path coordinates to a grid of this many pixels for smaller SVG files")
+    parser.add_argument('--tables', nargs='+', choices=['npy', 'parquet'], default=[],
+                        help="also write the metrics of the blocks of every face as a table next to its SVG file, "
+                             "and with npy the table of all faces to blocks.npy in the input folder")
+    parser.add_argument('--index', action='store_true',
+                        help="also write a spatial index of the blocks of every face next to its SVG file, for range, "
+                             "nearest and adjacency queries, see block_index.py")
+    parser.add_argument('--tile-size', type=int,
+                        help="find the contours of layers larger than this many pixels in tiles of that size, in "
+                             "parallel threads")
+    parser.add_argument('--tile-workers', type=int,
+                        help="number of threads per conversion working on the tiles of a layer (default: number "
+                             "of CPUs)")
+    parser.add_argument('--extraction', choices=['contours', 'components'], default='contours',
+                        help="find the blocks of every layer by their contours, or from a labelling of its "
+                             "connected components, which can leave out small specks (default: %(default)s)")
+    parser.add_argument('--min-block-area', type=int, default=0,
+                        help="with --extraction components, leave out the blocks smaller than this many pixels "
+                             "(default: %(default)s)")
+    parser.add_argument('--decode-workers', type=int,
+                        help="number of threads per conversion decoding the next layers while the current one is "
+                             "vectorized (default: decode every layer when it is its turn)")
+    parser.add_argument('--decode-queue', type=int, default=DECODE_QUEUE,
+                        help="number of layers decoded ahead with --decode-workers, which caps the memory the "
+                             "decoded layers take (default: %(default)s)")
+    parser.add_argument('--courses', type=parse_courses, nargs='+',
+                        help="only convert the layers of these courses, like 3 or 5-7; the SVG files then only have "
+                             "the blocks of these courses")
+    parser.add_argument('--groups', nargs='+',
+                        help="only convert the layers in groups with a name matching one of these patterns, like "
+                             "'Course 1?'")
+    parser.add_argument('--visible-only', action='store_true', help="skip the hidden layers and groups")
+    parser.add_argument('--list', action='store_true',
+                        help="list the courses and layers of the PSD files, without decoding or converting them")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="show log messages from this level on (default: INFO)")
+    parser.add_argument('--timings', help="write the time spent in every stage of the conversions to this JSON file")
+    args = parser.parse_args()
+    if 'parquet' in args.tables and block_table.pyarrow is None:
+        parser.error("install the pyarrow package to write the block tables as Parquet files")
+    if args.decode_queue < 0:
+        parser.error("--decode-queue must be 0 or more")
+    if args.extraction == 'components' and args.tile_size:
+        parser.error("--tile-size only applies to --extraction contours")
+    if args.min_block_area and args.extraction != 'components':
+        parser.error("--min-block-area needs --extraction components")
+    configure_logging(args.log_level)
+
+    selection = None
+    if args.courses or args.groups or args.visible_only:
+        courses = [course for courses in args.courses or () for course in courses]
+        selection = LayerSelection(courses, args.groups, args.visible_only)
+    if args.list:
+        for psd_path, _ in find_psd_files(args.input):
+            print('\n'.join(list_layers(psd_path, selection)))
+        return
+
+    start = time.perf_counter()
+    converter = PSDConverter(low_memory=args.low_memory, cache_dir=args.cache_dir,
+                             cache_size=args.cache_size * 1024 * 1024, compact=args.compact, quantize=args.quantize,
+                             tile_size=args.tile_size, tile_workers=args.tile_workers, tables=args.tables,
+                             index=args.index, decode_workers=args.decode_workers, decode_queue=args.decode_queue,
+                             selection=selection, extraction=args.extraction, min_block_area=args.min_block_area)
+    results = convert_batch(find_psd_files(args.input), args.workers, converter)
+    if 'npy' in args.tables:
+        write_corpus_table(os.path.join(args.input, CORPUS_TABLE),
+                           [table_path(result.svg_path) for result in results if not result.error])
+    seconds = time.perf_counter() - start
+    print_summary(results, seconds)
+    if args.timings:
+        write_timings(args.timings, results, seconds)
+
+    if any(result.error for result in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import traceback
+from dataclasses import dataclass
+from functools import partial
+
+import block_table
+import psd_to_svg
+from block_index import write_index
+from block_table import CORPUS_TABLE, BlockTable, table_path, write_corpus_table, write_table
+from psd_to_svg import FaceState, add_custom_attributes_in_memory
+from svg_reader import read_face
+from svg_writer import write_svg
+
+log = logging.getLogger('recompute_attributes')
+
+
+@dataclass
+class RecomputeResult:
+    svg_path: str
+    seconds: float
+    error: str = None
+    block_count: int = 0
+
+
+def find_svg_files(input_folder):
+    """Return the paths of all SVG files below the input folder."""
+    return sorted(os.path.join(root, filename) for root, _, files in os.walk(input_folder)
+                  for filename in files if filename.endswith('.svg'))
+
+
+def recompute_face(svg_path, compact=False, tables=(), index=False):
+    """Compute the custom attributes of the blocks of a converted SVG file again and write it back.
+
+    The blocks are read from the file, with the course and the block number from their group ids, and go through
+    the same attribute computation as in the converter, course by course, so the file ends up as if it had been
+    converted with the current code. Nothing is decoded or vectorized.
+    """
+    start = time.perf_counter()
+    try:
+        face = read_face(svg_path)
+        course_blocks = face.course_blocks()
+        state = FaceState()
+        if tables:
+            state.table = BlockTable(os.path.basename(svg_path).split('.')[0])
+        # Like the converter, also move on past the courses without blocks
+        for course in range(1, max(course_blocks, default=0) + 1):
+            add_custom_attributes_in_memory(course, state, course_blocks)
+            state.next_course()
+
+        write_svg(svg_path, face.width, face.height, face.paths, compact)
+        if tables:
+            write_table(svg_path, state.table.to_array(), tables)
+        if index:
+            write_index(svg_path, face.paths)
+    except Exception:
+        return RecomputeResult(svg_path, time.perf_counter() - start, traceback.format_exc())
+    log.debug("Recomputed the attributes of %s blocks of %s", len(face.paths), svg_path)
+    return RecomputeResult(svg_path, time.perf_counter() - start, block_count=len(face.paths))
+
+
+def recompute_batch(svg_paths, workers=None, compact=False, tables=(), index=False):
+    """Recompute the attributes of the SVG files in a pool of worker processes.
+
+    Recomputing a face takes a few milliseconds, so the files are handed to the workers in chunks rather than one
+    by one. A single worker recomputes the files in the current process.
+    """
+    recompute = partial(recompute_face, compact=compact, tables=tables, index=index)
+    if workers == 1 or len(svg_paths) <= 1:
+        return [recompute(svg_path) for svg_path in svg_paths]
+    chunksize = max(1, len(svg_paths) // (4 * (workers or os.cpu_count())))
+    with psd_to_svg.conversion_pool(workers) as executor:
+        return list(executor.map(recompute, svg_paths, chunksize=chunksize))
+
+
+def print_summary(results, seconds):
+    failures = [result for result in results if result.error]
+    log.info("Recomputed the attributes of %s of %s SVG files, %s blocks, in %.2fs",
+             len(results) - len(failures), len(results), sum(result.block_count for result in results), seconds)
+    for result in failures:
+        log.error("Error while recomputing %s:\n%s", result.svg_path, result.error)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compute the custom attributes of the blocks of the SVG files in the input folder again, "
+                    "without converting the PSD files.")
+    parser.add_argument('--input', default='./input', help="folder to search for SVG files (default: ./input)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument('--compact', action='store_true',
+                        help="write the SVG files without line breaks and indentation")
+    parser.add_argument('--tables', nargs='+', choices=['npy', 'parquet'], default=[],
+                        help="also write the metrics of the blocks of every face as a table next to its SVG file, "
+                             "and with npy the table of all faces to blocks.npy in the input folder")
+    parser.add_argument('--index', action='store_true',
+                        help="also write a spatial index of the blocks of every face next to its SVG file, see "
+                             "block_index.py")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="show log messages from this level on (default: INFO)")
+    args = parser.parse_args()
+    if 'parquet' in args.tables and block_table.pyarrow is None:
+        parser.error("install the pyarrow package to write the block tables as Parquet files")
+    psd_to_svg.configure_logging(args.log_level)
+
+    start = time.perf_counter()
+    results = recompute_batch(find_svg_files(args.input), args.workers, args.compact, args.tables,
+                               args.index)
+    if 'npy' in args.tables:
+        write_corpus_table(os.path.join(args.input, CORPUS_TABLE),
+                           [table_path(result.svg_path) for result in results if not result.error])
+    print_summary(results, time.perf_counter() - start)
+
+    if any(result.error for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from svg_writer import SVGPath
+
+# The attributes write_svg gives every path, the others are the custom attributes of the block
+PATH_ATTRIBUTES = ('id', 'd', 'stroke', 'fill', 'pointer-events')
+PATH_DATA_SEPARATORS = str.maketrans('MLZ,', '    ')
+CHUNK_SIZE = 1024 * 1024
+
+
+def parse_path_data(path_data):
+    """Return the point arrays of the ``d`` attributes of closed paths through integer points, like those written
+    by ``write_svg``, parsed all at once."""
+    counts = [d.count(',') for d in path_data]
+    text = ' '.join(path_data).translate(PATH_DATA_SEPARATORS)
+    values = np.fromstring(text, dtype=np.int64, sep=' ')
+    if len(values) != 2 * sum(counts):
+        raise ValueError("The paths are not made of M and L commands through integer points")
+    return np.split(values.reshape(-1, 2), np.cumsum(counts)[:-1]) if counts else []
+
+
+def parse_block_id(group_id):
+    """Return the course and the block number of a group id like ``N_3_12``."""
+    _, course, block_number = group_id.rsplit('_', 2)
+    return int(course), int(block_number)
+
+
+class FaceGeometry:
+    """The size and the blocks of a face, read from an SVG file written by the converter."""
+
+    def __init__(self, width, height, paths):
+        self.width = width
+        self.height = height
+        self.paths = paths
+
+    def course_blocks(self):
+        """Return the ``SVGPath`` objects by course, in block order, like ``Conversion.course_blocks``."""
+        courses = {}
+        for path in self.paths:
+            course, _ = parse_block_id(path.group_id)
+            courses.setdefault(course, []).append(path)
+        return {course: sorted(paths, key=lambda path: path.block_number) for course, paths in sorted(courses.items())}
+
+
+class FaceReader:
+    """Parser target collecting the blocks of an SVG file written by the converter, see ``read_face``."""
+
+    def __init__(self):
+        self.width = self.height = None
+        self.group_id = None
+        self.paths = []
+        self.path_data = []
+
+    def start(self, tag, attributes):
+        _, _, tag = tag.rpartition('}')
+        if tag == 'path' and self.group_id is not None:
+            _, block_number = parse_block_id(self.group_id)
+            path = SVGPath(self.group_id, attributes.get('id'), block_number, None)
+            path.attributes = {name: value for name, value in attributes.items() if name not in PATH_ATTRIBUTES}
+            self.paths.append(path)
+            self.path_data.append(attributes.get('d'))
+        elif tag == 'g':
+            self.group_id = attributes.get('id')
+        elif tag == 'svg' and self.width is None:
+            self.width, self.height = attributes.get('width'), attributes.get('height')
+
+    def end(self, tag):
+        if tag.rpartition('}')[2] == 'g':
+            self.group_id = None
+
+    def close(self):
+        for path, points in zip(self.paths, parse_path_data(self.path_data)):
+            path.points = points
+        return FaceGeometry(self.width, self.height, self.paths)
+
+
+def read_face(svg_path):
+    """Read the blocks of an SVG file written by the converter, streaming it through the XML parser.
+
+    Every block becomes an ``SVGPath`` with its outline as a point array and its custom attributes. No element
+    tree is built, and the path data of all blocks is parsed into point arrays at once.
+    """
+    parser = ET.XMLParser(target=FaceReader())
+    with open(svg_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            parser.feed(chunk)
+    return parser.close()
@@ -0,0 +1,59 @@
+from xml.sax.saxutils import quoteattr
+
+import numpy as np
+
+SVG_NAMESPACE = 'http://www.w3.org/2000/svg'
+BUFFER_SIZE = 1024 * 1024
+
+
+class SVGPath:
+    """The outline of a block and the attributes of its path element, to be written by ``write_svg``."""
+
+    __slots__ = ('group_id', 'path_id', 'block_number', 'points', 'attributes')
+
+    def __init__(self, group_id, path_id, block_number, points):
+        self.group_id = group_id
+        self.path_id = path_id
+        self.block_number = block_number
+        self.points = points
+        self.attributes = {}
+
+
+def quantize_points(points, step):
+    """Round the points to a grid of ``step`` pixels, dropping the points that fall onto the previous one."""
+    points = np.round(points / step).astype(np.int64) * step
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+    return points[keep]
+
+
+def path_data(points, compact=False, quantize=None):
+    """Return the ``d`` attribute of a closed path through the points, like ``M74,192 L12,193 L12,246 Z``."""
+    if quantize:
+        points = quantize_points(points, quantize)
+    separator = 'L' if compact else ' L'
+    closing = 'Z' if compact else ' Z'
+    xs, ys = np.asarray(points).T.tolist()
+    return 'M' + separator.join(map('{},{}'.format, xs, ys)) + closing
+
+
+def write_svg(svg_path, width, height, paths, compact=False, quantize=None):
+    """Write the SVG file with a group and a path for every ``SVGPath``, in one pass through a buffered file.
+
+    The groups and paths get ``pointer-events="all"`` so every block can be selected in the viewer. Unless
+    ``compact``, every element goes on its own, indented line. ``quantize`` rounds the coordinates to a grid of
+    that many pixels, which only changes the drawn outline, not the attributes computed before.
+    """
+    newline, indent = ('', '') if compact else ('\n', '  ')
+    with open(svg_path, 'w', encoding='utf-8', buffering=BUFFER_SIZE) as file:
+        file.write('<?xml version="1.0" encoding="utf-8" ?>\n')
+        file.write(f'<svg xmlns="{SVG_NAMESPACE}" baseProfile="tiny" version="1.2" width="{width}" height="{height}" '
+                   f'viewBox="0 0 {width} {height}">')
+        for path in paths:
+            # The attributes may be read back from other SVG files, with characters to escape
+            attributes = ''.join(f' {name}={quoteattr(str(value))}' for name, value in path.attributes.items())
+            file.write(f'{newline}{indent}<g id={quoteattr(path.group_id)} pointer-events="all">'
+                       f'{newline}{indent * 2}<path id={quoteattr(path.path_id)} '
+                       f'd="{path_data(path.points, compact, quantize)}" stroke="black" fill="none" '
+                       f'pointer-events="all"{attributes} />{newline}{indent}</g>')
+        file.write(f'{newline}</svg>\n')
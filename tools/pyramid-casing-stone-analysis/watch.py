@@ -0,0 +1,173 @@
+import os
+import time
+import logging
+import argparse
+import tempfile
+
+import psd_to_svg
+import webpagescript
+from cache import ContentCache, DEFAULT_CACHE_SIZE
+
+log = logging.getLogger('watch')
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Watcher:
+    """Polls the input folder and converts the PSD files that were added or changed, then rebuilds the viewer.
+
+    A PSD file is only converted once it has not changed for ``debounce`` seconds, so files that are still being
+    written, or saved several times in a row, are converted once. The converter, the viewer script and their
+    imports stay loaded between rebuilds.
+    """
+
+    def __init__(self, converter, cache, executor=None, split=False, compress=(), interval=0.5, debounce=1.0,
+                 lod=False):
+        self.converter = converter
+        self.cache = cache
+        self.executor = executor
+        self.split = split
+        self.compress = compress
+        self.lod = lod
+        self.interval = interval
+        self.debounce = debounce
+        self.built = {}  # psd_path: signature of the last conversion
+        self.failed = {}  # psd_path: signature of the last conversion, if it failed
+        self.pending = {}  # psd_path: (signature, time it was first seen)
+
+    def outdated_jobs(self):
+        """Return the jobs of the PSD files without an SVG file or with an older one than the PSD file."""
+        jobs = []
+        for psd_path, svg_path in psd_to_svg.find_psd_files('./input'):
+            if not os.path.exists(svg_path) or os.path.getmtime(svg_path) < os.path.getmtime(psd_path):
+                jobs.append((psd_path, svg_path))
+            else:
+                self.built[psd_path] = file_signature(psd_path)
+        return jobs
+
+    def poll(self):
+        """Return the jobs of the PSD files that changed and have been left alone for the debounce time."""
+        now = time.monotonic()
+        jobs = []
+        found = set()
+        for psd_path, svg_path in psd_to_svg.find_psd_files('./input'):
+            found.add(psd_path)
+            try:
+                signature = file_signature(psd_path)
+            except FileNotFoundError:  # Deleted since the folder was listed
+                continue
+            # A file that failed to convert is only tried again once it changes
+            if signature in (self.built.get(psd_path), self.failed.get(psd_path)):
+                self.pending.pop(psd_path, None)
+                continue
+
+            pending_signature, since = self.pending.get(psd_path, (None, None))
+            if pending_signature != signature:
+                self.pending[psd_path] = (signature, now)
+            elif now - since >= self.debounce:
+                jobs.append((psd_path, svg_path))
+
+        for psd_path in set(self.built) - found:
+            log.info("%s was removed, its SVG file is kept", psd_path)
+            del self.built[psd_path]
+        for psd_path in set(self.failed) - found:
+            del self.failed[psd_path]
+        return jobs
+
+    def rebuild(self, jobs, initial=False):
+        """Convert the PSD files of the jobs and rebuild the viewer, logging the time it took.
+
+        Only the face files of the converted PSD files are written again, unless it is the ``initial`` build.
+        """
+        start = time.perf_counter()
+        changed_since = min((self.pending.pop(psd_path, (None, time.monotonic()))[1] for psd_path, _ in jobs),
+                            default=time.monotonic())
+        signatures = {}
+        for psd_path, _ in jobs:
+            try:
+                signatures[psd_path] = file_signature(psd_path)
+            except OSError:  # Removed or renamed since the last poll
+                log.info("%s is gone, it is not converted", psd_path)
+        jobs = [(psd_path, svg_path) for psd_path, svg_path in jobs if psd_path in signatures]
+
+        results = psd_to_svg.convert_batch(jobs, workers=1, converter=self.converter, executor=self.executor)
+        converted = time.perf_counter()
+        for result in results:
+            # Keep the signature from before the conversion, a change during it triggers another one
+            if result.error:
+                log.error("Error while converting %s:\n%s", result.psd_path, result.error)
+                self.failed[result.psd_path] = signatures[result.psd_path]
+            else:
+                self.built[result.psd_path] = signatures[result.psd_path]
+                self.failed.pop(result.psd_path, None)
+
+        only = None if initial else {os.path.basename(result.svg_path) for result in results if not result.error}
+        faces = webpagescript.build_viewer(self.cache, workers=1, split=self.split, compress=self.compress,
+                                           only=only, lod=self.lod)
+        done = time.perf_counter()
+        failed = sum(bool(result.error) for result in results) + sum(bool(face.error) for face in faces)
+        log.info("Rebuilt %s in %.2fs (converting %.2fs, viewer %.2fs), %.2fs after the change%s",
+                 ', '.join(os.path.basename(psd_path) for psd_path, _ in jobs) or 'the viewer', done - start,
+                 converted - start, done - converted, time.monotonic() - changed_since,
+                 f", {failed} failed" if failed else '')
+
+    def run(self):
+        # Also builds the viewer once, so the next rebuilds only clean the faces that changed
+        self.rebuild(self.outdated_jobs(), initial=True)
+        log.info("Watching ./input for changed PSD files, press Ctrl+C to stop")
+        while True:
+            jobs = self.poll()
+            if jobs:
+                self.rebuild(jobs)
+            time.sleep(self.interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert the PSD files in the input folder whenever they change and rebuild index.html.")
+    parser.add_argument('--interval', type=float, default=0.5,
+                        help="seconds between two looks at the input folder (default: %(default)s)")
+    parser.add_argument('--debounce', type=float, default=1.0,
+                        help="seconds a PSD file must stay unchanged before it is converted (default: %(default)s)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of worker processes kept around to convert several PSD files at once "
+                             "(default: convert in this process)")
+    parser.add_argument('--low-memory', action='store_true',
+                        help="decode and threshold one layer at a time into reused buffers to keep the peak memory low")
+    parser.add_argument('--split', action='store_true',
+                        help="write every face to its own file in the faces folder, see webpagescript.py")
+    parser.add_argument('--compress', nargs='+', choices=['gzip', 'brotli'], default=[],
+                        help="with --split, also write gzip or brotli precompressed face files")
+    parser.add_argument('--lod', action='store_true',
+                        help="also write coarse levels of detail of every face, see webpagescript.py")
+    parser.add_argument('--cache-dir',
+                        help="cache the blocks of every layer and the cleaned SVG files in this folder "
+                             "(default: a temporary folder for this session)")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help="size of the cache in MiB (default: %(default)s)")
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="show log messages from this level on (default: INFO)")
+    args = parser.parse_args()
+    psd_to_svg.configure_logging(args.log_level)
+
+    with tempfile.TemporaryDirectory() as folder:
+        cache_dir = args.cache_dir or folder
+        cache_size = args.cache_size * 1024 * 1024
+        converter = psd_to_svg.PSDConverter(low_memory=args.low_memory, cache_dir=cache_dir, cache_size=cache_size)
+        executor = psd_to_svg.conversion_pool(args.workers) if args.workers > 1 else None
+        watcher = Watcher(converter, ContentCache(cache_dir, cache_size), executor, args.split, args.compress,
+                          args.interval, args.debounce, args.lod)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+
+if __name__ == "__main__":
+    main()
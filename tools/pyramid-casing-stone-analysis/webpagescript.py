@@ -1,6 +1,54 @@
 import os
+import re
+import sys
+import gzip
+import time
+import base64
+import logging
+import argparse
+import tempfile
+import traceback
 import xml.etree.ElementTree as ET
 import json
+from array import array
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+
+from block_stats import HEATMAP_METRICS, heatmap_statistics, percentile_table
+from cache import ContentCache, DEFAULT_CACHE_SIZE, cache_key, file_digest
+from svg_writer import SVG_NAMESPACE, path_data
+
+try:
+    import brotli
+except ImportError:  # Optional, only needed to precompress the face files with brotli
+    brotli = None
+
+log = logging.getLogger('webpagescript')
+
+# Bump to invalidate the cached cleaned SVG files and block metrics when the cleaning changes
+CLEAN_VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+# The coarse block outlines drop the points closer than this fraction of the arc length to the outline through
+# the others, like the 1% of APPROX_EPSILON in psd_to_svg.py
+LOD_EPSILON = 0.05
+
+# The block metrics the viewer works with: its name for them (the lowercased path attribute), the path attribute,
+# and the array typecode and JavaScript typed array type of their column
+BLOCK_METRICS = [
+    ('width', 'Width', 'i', 'Int32Array'),
+    ('widthpctcrse', 'WidthPctCrse', 'd', 'Float64Array'),
+    ('angle_top', 'angle_top', 'h', 'Int16Array'),
+    ('angle_bottom', 'angle_bottom', 'h', 'Int16Array'),
+    ('angle_left', 'angle_left', 'h', 'Int16Array'),
+    ('angle_right', 'angle_right', 'h', 'Int16Array'),
+    ('course', 'Course', 'i', 'Int32Array'),
+    ('iscorner', 'IsCorner', 'B', 'Uint8Array'),
+    ('isoffloaded', 'IsOffloaded', 'B', 'Uint8Array'),
+]
 
 def clean_svg(svg_content):
     # Parse the SVG content
@@ -11,6 +59,11 @@ def clean_svg(svg_content):
     for elem in root.iter():
         _, _, elem.tag = elem.tag.rpartition('}')
 
+    clean_root(root)
+    return ET.tostring(root, encoding='utf-8', method='xml').decode('utf-8')
+
+
+def clean_root(root):
     # Correct the xmlns attribute
     root.attrib['xmlns'] = 'http://www.w3.org/2000/svg'
     root.attrib.pop('xmlns:ns0', None)  # Remove any non-standard xmlns attributes
@@ -21,23 +74,388 @@ def clean_svg(svg_content):
         height = root.attrib.get('height', '800')
         root.attrib['viewBox'] = f'0 0 {width} {height}'
 
-    return ET.tostring(root, encoding='utf-8', method='xml').decode('utf-8')
 
+def iter_clean_svg(svg_path, metrics=None, lod=None):
+    """Yield the SVG file cleaned like ``clean_svg``, one element below the root at a time.
+
+    Only the element being parsed is kept in memory, so the memory does not grow with the size of the file. The
+    attributes of the paths are added to ``metrics``, a ``BlockMetrics``, and to ``lod``, a ``LevelsOfDetail``,
+    if given.
+    """
+    depth = 0
+    root = previous = None
+    for event, element in ET.iterparse(svg_path, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 1:
+                root = element
+                if lod is not None:
+                    lod.start(root.attrib)
+            elif depth == 2:
+                # The root text and the tail of the previous element are only known once the next element starts
+                yield start_tag(root) if previous is None else clean_element(previous, metrics, lod)
+                if previous is not None:
+                    root.remove(previous)
+            continue
+
+        depth -= 1
+        if depth == 1:
+            previous = element
+        elif depth == 0:
+            if previous is None:
+                for elem in root.iter():
+                    _, _, elem.tag = elem.tag.rpartition('}')
+                clean_root(root)
+                yield ET.tostring(root, encoding='unicode')
+            else:
+                yield clean_element(previous, metrics, lod)
+                yield f'</{root.tag}>'
+
+
+def start_tag(root):
+    """Return the cleaned start tag and text of the root element, serialized like ``ET.tostring`` does."""
+    _, _, tag = root.tag.rpartition('}')
+    shell = ET.Element(tag, root.attrib)
+    clean_root(shell)
+    shell.text = root.text
+    ET.SubElement(shell, 'end')
+    root.tag = tag
+    serialized = ET.tostring(shell, encoding='unicode')
+    return serialized[:serialized.rindex('<end />')]
+
+
+def clean_element(element, metrics=None, lod=None):
+    """Return the element, below the root, with the namespace prefixes removed and its tail, serialized."""
+    for elem in element.iter():
+        _, _, elem.tag = elem.tag.rpartition('}')
+        if elem.tag == 'path':
+            if metrics is not None:
+                metrics.add(elem.attrib)
+            if lod is not None:
+                lod.add(elem.attrib)
+    return ET.tostring(element, encoding='unicode')
+
+
+class BlockMetrics:
+    """The block metrics of the paths of a face as typed columns, in document order."""
+
+    def __init__(self):
+        self.count = 0
+        self.columns = {name: array(typecode) for name, _, typecode, _ in BLOCK_METRICS}
+
+    def add(self, attributes):
+        """Add the metrics of a path. Missing attributes count as 0 and 'True' as 1, like the viewer did when it
+        read the attributes."""
+        for name, attribute, typecode, _ in BLOCK_METRICS:
+            value = attributes.get(attribute, '0')
+            if typecode == 'B':
+                self.columns[name].append(value == 'True')
+            elif typecode == 'd':
+                self.columns[name].append(float(value))
+            else:
+                self.columns[name].append(int(float(value)))
+        self.count += 1
+
+    def to_buffer(self):
+        """Return the layout of the columns as {name: [typed array type, byte offset]} and the buffer they are in."""
+        layout = {}
+        columns = []
+        offset = 0
+        for name, _, _, array_type in BLOCK_METRICS:
+            column = self.columns[name].tobytes()
+            layout[name] = [array_type, offset]
+            # Typed arrays must start at a multiple of their element size
+            padding = -len(column) % 8
+            columns.append(column + bytes(padding))
+            offset += len(column) + padding
+        return layout, b''.join(columns)
+
+
+class LevelsOfDetail:
+    """Coarse levels of detail of a face for the viewer to show while zoomed out, in an SVG of their own.
+
+    The ``outlines`` are the block outlines simplified with ``LOD_EPSILON``, in the document order of the paths so
+    the block metrics apply to them as well. The ``bands`` are the bounding boxes of the courses.
+    """
 
+    def __init__(self):
+        self.root_attributes = {}
+        self.outlines = []
+        self.bands = {}  # course: [min x, min y, max x, max y]
+        self.total_width = 0
+
+    def start(self, root_attributes):
+        """Take the size and viewBox from the attributes of the root of the SVG file, cleaned like ``clean_root``."""
+        shell = ET.Element('svg', root_attributes)
+        clean_root(shell)
+        self.root_attributes = {name: shell.attrib[name] for name in ('width', 'height', 'viewBox')
+                                if name in shell.attrib}
 
+    def add(self, attributes):
+        """Add the coarse outline of a path, which only has absolute M and L commands, and grow its course band."""
+        points = np.array(re.findall(r'-?[\d.]+', attributes.get('d', '')), dtype=np.float32).reshape(-1, 2)
+        if not len(points):
+            self.outlines.append('')
+            return
+
+        curve = points.reshape(-1, 1, 2)
+        coarse = cv2.approxPolyDP(curve, LOD_EPSILON * cv2.arcLength(curve, True), True)
+        self.outlines.append(path_data(np.round(coarse.reshape(-1, 2)).astype(np.int64), compact=True))
+
+        (min_x, min_y), (max_x, max_y) = points.min(axis=0).tolist(), points.max(axis=0).tolist()
+        self.total_width += max_x - min_x
+        course = int(float(attributes.get('Course', '0')))
+        band = self.bands.setdefault(course, [min_x, min_y, max_x, max_y])
+        band[:] = min(band[0], min_x), min(band[1], min_y), max(band[2], max_x), max(band[3], max_y)
+
+    def chunks(self):
+        """Yield the SVG of the levels of detail, once all paths have been added."""
+        block_size = self.total_width / len(self.outlines) if self.outlines else 0
+        attributes = ''.join(f' {name}="{value}"' for name, value in self.root_attributes.items())
+        yield f'<svg xmlns="{SVG_NAMESPACE}" class="lod"{attributes} data-block-size="{block_size:.1f}">'
+        yield '<g class="bands">'
+        for course, (min_x, min_y, max_x, max_y) in sorted(self.bands.items()):
+            yield (f'<path class="band" data-course="{course}" '
+                   f'd="M{min_x:g},{min_y:g}L{max_x:g},{min_y:g}L{max_x:g},{max_y:g}L{min_x:g},{max_y:g}Z"/>')
+        yield '</g><g class="outlines">'
+        for start in range(0, len(self.outlines), 1000):
+            yield ''.join(f'<path d="{d}"/>' for d in self.outlines[start:start + 1000])
+        yield '</g></svg>'
+
+
+
+
+
+class Face:
+    """A face cleaned on the fly while its SVG file in the input folder is read, with its coarse levels of detail
+    if ``lod``."""
+
+    def __init__(self, svg_filename, lod=False):
+        self.svg_filename = svg_filename
+        self.block_metrics = BlockMetrics()
+        self.levels_of_detail = LevelsOfDetail() if lod else None
+
+    @property
+    def lod(self):
+        return self.levels_of_detail is not None
+
+    def chunks(self):
+        return iter_clean_svg(f'input/{self.svg_filename}', self.block_metrics, self.levels_of_detail)
+
+    def lod_chunks(self):
+        """Return the chunks of the SVG of the levels of detail, once the chunks of the face have been read."""
+        return self.levels_of_detail.chunks()
+
+    def metrics(self):
+        """Return the number of blocks, the column layout and the buffer, once the chunks have been read."""
+        layout, buffer = self.block_metrics.to_buffer()
+        return self.block_metrics.count, layout, buffer
+
+
+@dataclass
+class CleanedFace:
+    """A face cleaned ahead by ``clean_face``, with its cleaned SVG and block metrics in files."""
+    svg_filename: str
+    svg_path: str = None
+    metrics_path: str = None
+    lod_path: str = None
+    seconds: float = None
+    cached: bool = False
+    error: str = None
+
+    @property
+    def lod(self):
+        return self.lod_path is not None
+
+    def chunks(self):
+        return read_chunks(self.svg_path)
+
+    def lod_chunks(self):
+        return read_chunks(self.lod_path)
+
+    def metrics(self):
+        with open(self.metrics_path, 'rb') as file:
+            header = json.loads(file.readline())
+            return header['count'], header['layout'], file.read()
+
+
+def metrics_columns(count, layout, buffer):
+    """Return the block metrics columns of the ``metrics`` of a face as arrays, by the viewer's name for them."""
+    typecodes = {name: typecode for name, _, typecode, _ in BLOCK_METRICS}
+    return {name: np.frombuffer(buffer, typecodes[name], count, offset) for name, (_, offset) in layout.items()}
+
+
+def face_statistics(columns):
+    """Return the statistics of the heatmap metrics of a face and its courses, see ``block_stats``."""
+    return heatmap_statistics(columns['width'], columns['widthpctcrse'], columns['iscorner'], columns['course'])
+
+
+def heatmap_percentiles(face_columns):
+    """Return the percentile tables the heatmap looks the bounds up in, for both metrics, of the blocks of all
+    faces and without the corner blocks, empty without any faces."""
+    if not face_columns:
+        return {name: {'all': [], 'without_corners': []} for name in HEATMAP_METRICS}
+    is_corner = np.concatenate([columns['iscorner'] for columns in face_columns]).astype(bool)
+    percentiles = {}
+    for name in HEATMAP_METRICS:
+        values = np.concatenate([columns[name] for columns in face_columns])
+        percentiles[name] = {'all': percentile_table(values).tolist(),
+                             'without_corners': percentile_table(values[~is_corner]).tolist()}
+    return percentiles
+
+
+def write_statistics(path, faces):
+    """Write the statistics of the heatmap metrics of all faces together, of every face and of its courses as
+    JSON. Without any faces, there are no statistics of all faces."""
+    face_columns = {face.svg_filename: metrics_columns(*face.metrics()) for face in faces}
+    statistics = {'faces': {svg_filename: face_statistics(columns) for svg_filename, columns in face_columns.items()}}
+    if face_columns:
+        corpus = {name: np.concatenate([columns[name] for columns in face_columns.values()])
+                  for name in ('width', 'widthpctcrse', 'iscorner')}
+        statistics = {'corpus': heatmap_statistics(corpus['width'], corpus['widthpctcrse'], corpus['iscorner']),
+                      **statistics}
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(statistics, file, indent=2)
 
 
-def generate_html(svg_filenames):
+def read_chunks(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        yield from iter(lambda: file.read(CHUNK_SIZE), '')
 
-    # Load all SVG contents and clean them
-    cleaned_svg_contents = []
-    for svg_filename in svg_filenames:
-        with open(f'input/{svg_filename}', 'r', encoding='utf-8') as file:
-            svg_content = file.read()
-        cleaned_svg_contents.append(clean_svg(svg_content))
 
-    # Escape the SVG contents for embedding in a JavaScript array
-    escaped_svg_contents = [content.replace("'", r"\'") for content in cleaned_svg_contents]
+def clean_face(svg_filename, cache, lod=False):
+    """Clean the SVG file of the face in the input folder into the cache, unless it is there already, along with
+    its coarse levels of detail if ``lod``.
+
+    The entries are keyed by the content of the SVG file, so a face is only cleaned again once it changed.
+    """
+    start = time.perf_counter()
+    try:
+        digest = file_digest(f'input/{svg_filename}')
+        svg_key = cache_key('clean-svg', CLEAN_VERSION, digest)
+        metrics_key = cache_key('block-metrics', CLEAN_VERSION, digest)
+        lod_key = cache_key('lod-svg', CLEAN_VERSION, LOD_EPSILON, digest)
+        svg_path, metrics_path = cache.lookup(svg_key), cache.lookup(metrics_key)
+        lod_path = cache.lookup(lod_key) if lod else None
+        if svg_path is not None and metrics_path is not None and (lod_path is not None or not lod):
+            return CleanedFace(svg_filename, svg_path, metrics_path, lod_path, time.perf_counter() - start,
+                               cached=True)
+
+        face = Face(svg_filename, lod)
+        with cache.writer(svg_key) as file:
+            for chunk in face.chunks():
+                file.write(chunk.encode('utf-8'))
+        count, layout, buffer = face.metrics()
+        with cache.writer(metrics_key) as file:
+            file.write(json.dumps({'count': count, 'layout': layout}).encode('utf-8') + b'\n')
+            file.write(buffer)
+        if lod:
+            with cache.writer(lod_key) as file:
+                for chunk in face.lod_chunks():
+                    file.write(chunk.encode('utf-8'))
+        return CleanedFace(svg_filename, cache.path(svg_key), cache.path(metrics_key),
+                           cache.path(lod_key) if lod else None, time.perf_counter() - start)
+    except Exception:
+        return CleanedFace(svg_filename, seconds=time.perf_counter() - start, error=traceback.format_exc())
+
+
+def clean_faces(svg_filenames, cache, workers=None, lod=False):
+    """Clean the SVG files of the faces into the cache in a pool of worker processes, see ``clean_face``."""
+    if workers == 1 or len(svg_filenames) <= 1:
+        return [clean_face(svg_filename, cache, lod) for svg_filename in svg_filenames]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(clean_face, svg_filenames, [cache] * len(svg_filenames), [lod] * len(svg_filenames)))
+
+
+def print_report(faces, seconds):
+    log.info("Cleaned %s SVG files in %.2fs:", len(faces), seconds)
+    for face in faces:
+        status = 'FAILED' if face.error else 'cache hit' if face.cached else 'cleaned'
+        log.info("  %s: %s (%.2fs)", face.svg_filename, status, face.seconds)
+    for face in faces:
+        if face.error:
+            log.error("Error while cleaning %s:\n%s", face.svg_filename, face.error)
+
+
+def write_face_files(svg_filenames, folder='faces', compress=(), faces=None, only=None, lod=False):
+    """Write the cleaned SVG and the block metrics of every face to their own files in the folder, and with
+    ``lod`` its coarse levels of detail, like ``North.lod.svg``.
+
+    The faces are cleaned on the way, unless they are given as ``CleanedFace`` objects. Returns the URLs of the
+    SVG files and the block metrics entries for ``generate_html``. ``compress`` may contain 'gzip' and 'brotli'
+    to write precompressed copies next to the files, like ``North.svg.gz``, for web servers that serve those in
+    their place. With cleaned faces, the files can be limited to the SVG file names in ``only``.
+    """
+    if 'brotli' in compress and brotli is None:
+        raise RuntimeError("Install the brotli package to precompress the face files with brotli")
+
+    os.makedirs(folder, exist_ok=True)
+    face_urls = []
+    face_metrics = []
+    for svg_filename, face in zip(svg_filenames, faces or (Face(svg_filename, lod) for svg_filename in svg_filenames)):
+        write = only is None or svg_filename in only
+        if write:
+            chunks = (chunk.encode('utf-8') for chunk in face.chunks())
+            write_face_file(os.path.join(folder, svg_filename), chunks, compress)
+
+        count, layout, buffer = face.metrics()
+        name = os.path.splitext(svg_filename)[0]
+        metrics_filename = name + '.blocks'
+        if write:
+            write_face_file(os.path.join(folder, metrics_filename), [buffer], compress)
+            if face.lod:
+                chunks = (chunk.encode('utf-8') for chunk in face.lod_chunks())
+                write_face_file(os.path.join(folder, name + '.lod.svg'), chunks, compress)
+
+        face_urls.append(f'{folder}/{svg_filename}')
+        face_metrics.append({'count': count, 'layout': layout, 'url': f'{folder}/{metrics_filename}'})
+    return face_urls, face_metrics
+
+
+def write_face_file(face_path, chunks, compress=()):
+    """Write the chunks of bytes to the file, and to its precompressed copies, as they come."""
+    with ExitStack() as stack:
+        streams = [stack.enter_context(open(face_path, 'wb'))]
+        if 'gzip' in compress:
+            gzip_file = stack.enter_context(open(face_path + '.gz', 'wb'))
+            streams.append(stack.enter_context(gzip.GzipFile('', 'wb', 9, gzip_file, mtime=0)))
+        compressor = None
+        if 'brotli' in compress:
+            brotli_file = stack.enter_context(open(face_path + '.br', 'wb'))
+            compressor = brotli.Compressor()
+
+        for chunk in chunks:
+            for stream in streams:
+                stream.write(chunk)
+            if compressor is not None:
+                brotli_file.write(compressor.process(chunk))
+        if compressor is not None:
+            brotli_file.write(compressor.finish())
+
+
+def generate_html(svg_filenames, face_urls=None, face_metrics=None, faces=None, lod=False):
+    """Return the viewer page with the SVG and block metrics of every face inlined, or loaded from ``face_urls``
+    and the URLs in ``face_metrics`` when it is shown."""
+    return ''.join(iter_html(svg_filenames, face_urls, face_metrics, faces, lod))
+
+
+def write_html(html_path, svg_filenames, face_urls=None, face_metrics=None, faces=None, lod=False):
+    """Write the viewer page as it is generated, see ``iter_html``."""
+    with open(html_path, 'w', encoding='utf-8') as file:
+        for chunk in iter_html(svg_filenames, face_urls, face_metrics, faces, lod):
+            file.write(chunk)
+
+
+def iter_html(svg_filenames, face_urls=None, face_metrics=None, faces=None, lod=False):
+    """Yield the viewer page in chunks, with the SVG of every face streamed from its file while it is cleaned,
+    or from the files of the ``CleanedFace`` objects in ``faces``.
+
+    With ``lod``, the viewer shows the coarse levels of detail of a face until it is zoomed in far enough for the
+    blocks to be told apart. The face files are then only fetched once they are needed, the coarse levels being
+    fetched from the ``.lod.svg`` files next to them.
+    """
+    lod_urls = [os.path.splitext(url)[0] + '.lod.svg' for url in face_urls] if lod and face_urls else None
 
     # Add a dark mode toggle button to the menu
     dark_mode_toggle_button = "<button id='dark-mode-toggle' onclick='toggleDarkMode()'>Toggle Dark Mode</button>"
@@ -46,7 +464,7 @@ def generate_html(svg_filenames):
     # Generate HTML content
 
    
-    html_content = f"""
+    yield f"""
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -92,6 +510,15 @@ def generate_html(svg_filenames):
         height: 100%;
     }}
     
+    /* The level of detail shown of faces with coarse levels, picked by the viewer from the zoom */
+    .svg-container div[data-level="bands"] svg:not(.lod),
+    .svg-container div[data-level="outlines"] svg:not(.lod),
+    .svg-container div[data-level="full"] svg.lod,
+    .svg-container div[data-level="bands"] svg.lod g.outlines,
+    .svg-container div[data-level="outlines"] svg.lod g.bands {{
+        display: none;
+    }}
+    
       .svg-container svg path {{
         fill: none; /* This ensures paths are not filled with green by default */
         stroke: black; /* Default stroke color */
@@ -209,7 +636,7 @@ def generate_html(svg_filenames):
                 <legend>Highlight Angles</legend>
 
         <label for="angle-threshold">Min Angle Deviation:</label>
-        <input type="range" id="angle-threshold" min="0" max="90" value="20" oninput="updateAngleHighlights(); document.getElementById('angle-value').innerText = this.value + '°'">
+        <input type="range" id="angle-threshold" min="0" max="90" value="20">
         <span id="angle-value">1°</span>
    <button id="angle-button">Highlight angled blocks</button>
             </fieldset>
@@ -230,23 +657,66 @@ def generate_html(svg_filenames):
             <input type="number" id="upper-percentile" min="0" max="100" value="50">
             <button onclick="heatmap()">Heatmap</button>
         </fieldset>
+      <fieldset>
+            <legend>Zoom</legend>
+            <button onclick="setZoom(zoom * 2)">Zoom in</button>
+            <button onclick="setZoom(zoom / 2)">Zoom out</button>
+            <button onclick="setZoom(1)">Whole face</button>
+        </fieldset>
     </div>
 </div>
 </div>
   <div class="svg-container" id="svg-container">
-            {''.join(f'<div style="display: {"none" if i else "block"};">{content}</div>' for i, content in enumerate(escaped_svg_contents))}
+            """
+
+    inline = face_urls is None
+    if inline:
+        face_metrics = []
+        face_columns = []
+    for i, face in enumerate(faces or (Face(svg_filename, lod) for svg_filename in svg_filenames)):
+        # Faces with levels of detail start out with the block outlines, until the viewer picks the level
+        level = ' data-level="outlines"' if lod else ''
+        yield f'<div style="display: {"none" if i else "block"};"{level}>'
+        if inline:
+            for chunk in face.chunks():
+                # Escape the SVG contents for embedding in a JavaScript array
+                yield chunk.replace("'", r"\'")
+            if lod:
+                for chunk in face.lod_chunks():
+                    yield chunk.replace("'", r"\'")
+            count, layout, buffer = face.metrics()
+            face_metrics.append({'count': count, 'layout': layout, 'data': base64.b64encode(buffer).decode('ascii')})
+            face_columns.append(metrics_columns(count, layout, buffer))
+        yield '</div>'
+
+    if not inline:
+        face_columns = []
+        for metrics in face_metrics:
+            with open(metrics['url'], 'rb') as file:
+                face_columns.append(metrics_columns(metrics['count'], metrics['layout'], file.read()))
+
+    yield f"""
         </div>
 
     </div>
     <script>
         let angleHighlightingActive = false;   
-        let svgContents = {json.dumps(escaped_svg_contents)};
         let svgFilenames = {json.dumps(svg_filenames)};
+        let faceUrls = {json.dumps(face_urls)};  // null when the faces are inlined
+        let faceLoads = {{}};
+        let lodUrls = {json.dumps(lod_urls)};  // The coarse levels of detail, fetched before the faces when split
+        let zoom = 1;
+        // The coarsest level whose blocks still are wider on screen than this many pixels is shown
+        const LEVEL_BLOCK_SIZES = {{bands: 4, outlines: 16}};
+        let blockMetrics = {json.dumps(face_metrics)};
+        // The values at the percentiles 0 to 100 of the heatmap attributes of the blocks of all faces
+        let heatmapPercentiles = {json.dumps(heatmap_percentiles(face_columns))};
+        let faces = [];  // The paths, block metrics columns and current fills of the loaded faces
         let currentIndex = 0;
         let isHighlighted = {{}};
         let isAngledHighlighted = false;
         let isHeatmapApplied = false;
-        let highlightingStates = svgContents.map(() => ({{}}));
+        let highlightingStates = svgFilenames.map(() => ({{}}));
 
         let isDarkMode = true; // Set default state to true
 
@@ -258,34 +728,145 @@ def generate_html(svg_filenames):
             document.getElementById('dark-mode-toggle').textContent = isDarkMode ? 'Switch to Light Mode' : 'Toggle Dark Mode';
         }}
 
+        function decodeBase64(data) {{
+            return Uint8Array.from(atob(data), character => character.charCodeAt(0)).buffer;
+        }}
+
+        function fetchSVG(url, container) {{
+            return fetch(url)
+                .then(response => response.text())
+                .then(svg => container.insertAdjacentHTML('beforeend', svg));
+        }}
+
+        // Fetch the SVG and the block metrics of a face the first time it is shown, unless they are inlined. With
+        // levels of detail, the coarse ones are fetched first and the face itself once it is zoomed in on
+        function loadFace(index) {{
+            if (!faceLoads[index]) {{
+                let container = document.querySelectorAll('.svg-container > div')[index];
+                let metrics = blockMetrics[index];
+                let svgUrl = lodUrls ? lodUrls[index] : faceUrls ? faceUrls[index] : null;
+                let svgLoad = svgUrl ? fetchSVG(svgUrl, container) : Promise.resolve();
+                let metricsLoad = metrics.url ? fetch(metrics.url).then(response => response.arrayBuffer())
+                    : Promise.resolve(decodeBase64(metrics.data));
+                faceLoads[index] = Promise.all([svgLoad, metricsLoad]).then(([, buffer]) => {{
+                    // The metrics are in the document order of the paths, and of the coarse block outlines
+                    let paths = Array.from(container.querySelectorAll('svg:not(.lod) path'));
+                    let outlines = Array.from(container.querySelectorAll('svg.lod g.outlines path'));
+                    let columns = {{}};
+                    for (let [name, [type, offset]] of Object.entries(metrics.layout)) {{
+                        columns[name] = new window[type](buffer, offset, metrics.count);
+                    }}
+                    faces[index] = {{paths, outlines, columns, fills: new Array(metrics.count).fill(''),
+                                    angled: new Uint8Array(metrics.count), fullLoad: lodUrls ? null : svgLoad}};
+                    if (angleHighlightingActive) {{
+                        updateAngleHighlights();
+                    }}
+                    updateLevel(index);
+                }});
+            }}
+            return faceLoads[index];
+        }}
+
+        // Fetch the full geometry of a face shown with its levels of detail, and bring it up to date with them
+        function loadFullFace(index) {{
+            let face = faces[index];
+            if (!face.fullLoad) {{
+                let container = document.querySelectorAll('.svg-container > div')[index];
+                face.fullLoad = fetchSVG(faceUrls[index], container).then(() => {{
+                    // The face comes in after the zoom was set on the coarse levels
+                    sizeFace(container);
+                    face.paths = Array.from(container.querySelectorAll('svg:not(.lod) path'));
+                    face.paths.forEach((path, pathIndex) => {{
+                        path.style.fill = face.fills[pathIndex];
+                        if (face.angled[pathIndex]) {{
+                            path.classList.add('highlighted');
+                            path.style.stroke = 'red';
+                        }}
+                    }});
+                }});
+            }}
+            return face.fullLoad;
+        }}
+
+        function sizeFace(container) {{
+            container.querySelectorAll('svg').forEach(svg => {{
+                svg.style.width = svg.style.height = zoom * 100 + '%';
+            }});
+        }}
+
+        // Size the face to the zoom and show the coarsest level of detail whose blocks are still large enough
+        function updateLevel(index) {{
+            let container = document.querySelectorAll('.svg-container > div')[index];
+            sizeFace(container);
+            let lod = container.querySelector('svg.lod');
+            let shown = Array.from(container.querySelectorAll('svg')).find(svg => svg.getBoundingClientRect().width);
+            if (!faces[index] || !lod || !shown) {{
+                return;
+            }}
+            let [, , width, height] = lod.getAttribute('viewBox').split(/[ ,]+/).map(Number);
+            let box = shown.getBoundingClientRect();
+            let scale = Math.min(box.width / width, box.height / height);
+            let blockSize = parseFloat(lod.getAttribute('data-block-size')) * scale;
+            let level = blockSize < LEVEL_BLOCK_SIZES.bands ? 'bands'
+                : blockSize < LEVEL_BLOCK_SIZES.outlines ? 'outlines' : 'full';
+            if (level === 'full' && lodUrls) {{
+                // Keep the coarse level until the face is there
+                loadFullFace(index).then(() => {{ container.dataset.level = 'full'; }});
+            }} else {{
+                container.dataset.level = level;
+            }}
+        }}
+
+        function setZoom(value) {{
+            zoom = Math.min(Math.max(value, 1), 256);
+            updateLevel(currentIndex);
+        }}
+
+        // Only touch the paths whose fill changes, in the face and in its coarse block outlines
+        function setFill(face, pathIndex, color) {{
+            if (face.fills[pathIndex] !== color) {{
+                face.fills[pathIndex] = color;
+                for (let path of [face.paths[pathIndex], face.outlines[pathIndex]]) {{
+                    if (path) {{
+                        path.style.fill = color;
+                    }}
+                }}
+            }}
+        }}
+
         document.addEventListener('DOMContentLoaded', () => {{
+            // Inlined faces are all in the page already, the highlights and the heatmap cover all of them
+            if (faceUrls) {{
+                loadFace(currentIndex);
+            }} else {{
+                svgFilenames.forEach((filename, index) => loadFace(index));
+            }}
             document.getElementById('angle-button').addEventListener('click', toggleAngleHighlighting);
             document.getElementById('angle-threshold').addEventListener('input', function() {{
                 let angleValue = this.value;
                 document.getElementById('angle-value').innerText = angleValue + '°';
                 updateAngleHighlights();
             }});
+            document.getElementById('svg-container').addEventListener('wheel', event => {{
+                if (event.ctrlKey) {{
+                    event.preventDefault();
+                    setZoom(zoom * (event.deltaY < 0 ? 1.25 : 0.8));
+                }}
+            }}, {{passive: false}});
+            window.addEventListener('resize', () => updateLevel(currentIndex));
         }});
         
 
         document.addEventListener('keydown', event => {{
             if (event.key === 'ArrowRight') {{
-                currentIndex = (currentIndex + 1) % svgContents.length;
+                currentIndex = (currentIndex + 1) % svgFilenames.length;
                 updateSVG(currentIndex);
             }} else if (event.key === 'ArrowLeft') {{
-                currentIndex = (currentIndex - 1 + svgContents.length) % svgContents.length;
+                currentIndex = (currentIndex - 1 + svgFilenames.length) % svgFilenames.length;
                 updateSVG(currentIndex);
             }}
         }});
 
-        document.getElementById('svg-select').addEventListener('change', event => {{
-            currentIndex = parseInt(event.target.value);
-            updateSVG(currentIndex);
-        }});
-        
-        // Updated Angle and Width filters with real-time highlighting
-        document.getElementById('angle-threshold').addEventListener('input', updateAngleHighlights);
-           document.getElementById('angle-button').addEventListener('click', toggleAngleHighlighting);  // Button click listener
 
 
        function selectSVG(index) {{
@@ -304,12 +885,15 @@ def generate_html(svg_filenames):
         // Updated highlight function with correct syntax for embedding attribute variable
 
          function highlight(attribute, value, color) {{
-            let paths = document.querySelectorAll(`.svg-container svg *[${{attribute}}]`);  // Updated syntax
             let toggleOn = !isHighlighted[attribute + value];
-            paths.forEach((path, pathIndex) => {{
-                if (path.getAttribute(attribute) === value) {{
-                    path.style.fill = toggleOn ? color : '';
-                    highlightingStates[currentIndex][pathIndex] = toggleOn ? color : undefined;
+            let match = value === 'True' ? 1 : parseFloat(value);
+            faces.forEach((face, faceIndex) => {{
+                let column = face.columns[attribute];
+                for (let pathIndex = 0; pathIndex < column.length; pathIndex++) {{
+                    if (column[pathIndex] === match) {{
+                        setFill(face, pathIndex, toggleOn ? color : '');
+                        highlightingStates[faceIndex][pathIndex] = toggleOn ? color : undefined;
+                    }}
                 }}
             }});
             isHighlighted[attribute + value] = toggleOn;
@@ -340,24 +924,26 @@ function toggleHighlight(pathElement) {{
 
 function updateAngleHighlights() {{
     let threshold = parseInt(document.getElementById('angle-threshold').value);
-    let paths = document.querySelectorAll('.svg-container svg path');
-
-    paths.forEach(path => {{
-        const angleLeft = parseFloat(path.getAttribute('angle_left') || '0');
-        const angleRight = parseFloat(path.getAttribute('angle_right') || '0');
-        const totalAngle = angleLeft + angleRight;
 
-        const isAngleLeftInRange = (-angleLeft - 90 < -threshold || -angleLeft - 90 > threshold);
-        const isAngleRightInRange = (-angleRight - 90 < -threshold || -angleRight - 90 > threshold);
-
-        if ((isAngleLeftInRange || isAngleRightInRange) && angleHighlightingActive) {{
-            path.classList.add('highlighted');
-            path.style.fill = 'red';
-            path.style.stroke = 'red';
-        }} else {{
-            path.classList.remove('highlighted');
-            path.style.fill = '';
-            path.style.stroke = 'black';
+    faces.forEach(face => {{
+        const angleLeft = face.columns.angle_left;
+        const angleRight = face.columns.angle_right;
+
+        for (let pathIndex = 0; pathIndex < angleLeft.length; pathIndex++) {{
+            const isAngleLeftInRange = Math.abs(angleLeft[pathIndex] + 90) > threshold;
+            const isAngleRightInRange = Math.abs(angleRight[pathIndex] + 90) > threshold;
+            const angled = (isAngleLeftInRange || isAngleRightInRange) && angleHighlightingActive ? 1 : 0;
+
+            if (angled !== face.angled[pathIndex]) {{
+                face.angled[pathIndex] = angled;
+                setFill(face, pathIndex, angled ? 'red' : '');
+                for (let path of [face.paths[pathIndex], face.outlines[pathIndex]]) {{
+                    if (path) {{
+                        path.classList.toggle('highlighted', angled === 1);
+                        path.style.stroke = angled ? 'red' : 'black';
+                    }}
+                }}
+            }}
         }}
     }});
 }}
@@ -368,9 +954,9 @@ function updateAngleHighlights() {{
         
 
         function clearHighlights() {{
-            document.querySelectorAll('.svg-container svg path').forEach((path, pathIndex) => {{
-                path.style.fill = '';
-                highlightingStates[currentIndex][pathIndex] = undefined;
+            faces.forEach((face, faceIndex) => {{
+                face.fills.forEach((fill, pathIndex) => setFill(face, pathIndex, ''));
+                highlightingStates[faceIndex] = {{}};
             }});
             isHighlighted = {{}};
             isAngledHighlighted = false;
@@ -397,11 +983,14 @@ function updateAngleHighlights() {{
     document.querySelectorAll('.svg-container > div')[index].style.display = 'block';
 
     // Apply the highlighting state from the array
-    document.querySelectorAll('.svg-container svg path').forEach((path, pathIndex) => {{
-        let color = highlightingStates[index][pathIndex];
-        if (color !== undefined) {{
-            path.style.fill = color;
-       }}}});
+    loadFace(index).then(() => {{
+        for (let [pathIndex, color] of Object.entries(highlightingStates[index])) {{
+            if (color !== undefined) {{
+                setFill(faces[index], Number(pathIndex), color);
+            }}
+        }}
+        updateLevel(index);
+    }});
         }}
 
 
@@ -414,24 +1003,24 @@ function updateAngleHighlights() {{
     function heatmap() {{
         let excludeCorners = document.getElementById('exclude-corners').checked;
         let attribute = document.getElementById('heatmap-attribute-toggle').value;
-        let lowerPercentile = parseFloat(document.getElementById('lower-percentile').value) / 100;
-        let upperPercentile = parseFloat(document.getElementById('upper-percentile').value) / 100;
-        let paths = Array.from(document.querySelectorAll('.svg-container svg path'));
+        let lowerPercentile = parseFloat(document.getElementById('lower-percentile').value);
+        let upperPercentile = parseFloat(document.getElementById('upper-percentile').value);
         if (isHeatmapApplied) {{
-            paths.forEach(path => path.style.fill = '');
+            faces.forEach(face => face.fills.forEach((fill, pathIndex) => setFill(face, pathIndex, '')));
         }} else {{
-            let values = paths.map(path => excludeCorners && path.getAttribute('iscorner') === 'True' ? null : parseFloat(path.getAttribute(attribute) || '0'));
-            let filteredValues = values.filter(value => value !== null);
-            filteredValues.sort((a, b) => a - b);
-            let lowerValue = filteredValues[Math.floor(filteredValues.length * lowerPercentile)];
-            let upperValue = filteredValues[Math.floor(filteredValues.length * upperPercentile)];
-
-            paths.forEach((path, index) => {{
-                let value = values[index];
-                if (value !== null) {{
-                    let normalizedValue = (value - lowerValue) / (upperValue - lowerValue);
-                    let color = interpolateColor(normalizedValue);
-                    path.style.fill = color;
+            let excluded = (face, pathIndex) => excludeCorners && face.columns.iscorner[pathIndex] === 1;
+            let percentiles = heatmapPercentiles[attribute][excludeCorners ? 'without_corners' : 'all'];
+            let percentileValue = percentile => percentiles[Math.min(100, Math.max(0, Math.round(percentile)))];
+            let lowerValue = percentileValue(lowerPercentile);
+            let upperValue = percentileValue(upperPercentile);
+
+            faces.forEach(face => {{
+                let values = face.columns[attribute];
+                for (let pathIndex = 0; pathIndex < values.length; pathIndex++) {{
+                    if (!excluded(face, pathIndex)) {{
+                        let normalizedValue = (values[pathIndex] - lowerValue) / (upperValue - lowerValue);
+                        setFill(face, pathIndex, interpolateColor(normalizedValue));
+                    }}
                 }}
             }});
         }}
@@ -464,17 +1053,63 @@ function updateAngleHighlights() {{
 </html>
     """
 
-    return html_content
-
 
 def main():
+    parser = argparse.ArgumentParser(description="Generate index.html from the SVG files in the input folder.")
+    parser.add_argument('--split', action='store_true',
+                        help="write every face to its own file in the faces folder, loaded when it is shown, "
+                             "instead of inlining all faces in index.html")
+    parser.add_argument('--compress', nargs='+', choices=['gzip', 'brotli'], default=[],
+                        help="with --split, also write gzip or brotli precompressed face files")
+    parser.add_argument('--lod', action='store_true',
+                        help="also write coarse levels of detail of every face, shown by the viewer until it is "
+                             "zoomed in, for faces with very many blocks")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="number of worker processes cleaning the SVG files (default: number of CPUs)")
+    parser.add_argument('--stats',
+                        help="also write the statistics and percentiles of the heatmap attributes of all faces, of "
+                             "every face and of every course to this JSON file")
+    parser.add_argument('--cache-dir',
+                        help="cache the cleaned SVG files in this folder, so that unchanged faces are not cleaned "
+                             "again")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024),
+                        help="size of the cache in MiB, least recently used entries are evicted beyond it "
+                             "(default: %(default)s)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    # Without a cache folder, the faces are cleaned into a temporary one
+    with tempfile.TemporaryDirectory() as folder:
+        cache = ContentCache(args.cache_dir or folder, args.cache_size * 1024 * 1024)
+        faces = build_viewer(cache, args.workers, args.split, args.compress, lod=args.lod)
+        if args.stats and not any(face.error for face in faces):
+            write_statistics(args.stats, faces)
+        if args.cache_dir:
+            cache.evict()
+    if any(face.error for face in faces):
+        sys.exit(1)
+
+
+def build_viewer(cache, workers=None, split=False, compress=(), only=None, lod=False):
+    """Clean the SVG files in the input folder into the cache and write index.html, and with ``split`` the face
+    files, limited to the SVG file names in ``only`` if given. ``lod`` adds the coarse levels of detail of every
+    face. Returns the ``CleanedFace`` objects."""
     # Get all SVG file names from the 'input' directory
     svg_filenames = [f for f in os.listdir('input') if f.endswith('.svg')]
-    html_content = generate_html(svg_filenames)
 
+    start = time.perf_counter()
+    faces = clean_faces(svg_filenames, cache, workers, lod)
+    print_report(faces, time.perf_counter() - start)
+    if any(face.error for face in faces):
+        return faces
+
+    if split:
+        face_urls, face_metrics = write_face_files(svg_filenames, compress=compress, faces=faces, only=only, lod=lod)
+    else:
+        face_urls, face_metrics = None, None
     # Write the HTML content to a file
-    with open('index.html', 'w', encoding='utf-8') as file:
-        file.write(html_content)
+    write_html('index.html', svg_filenames, face_urls, face_metrics, faces, lod)
+    return faces
 
 if __name__ == "__main__":
     main()